@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+
+name = 'bench_pipeline'
+help = 'time each stage of the denoising pipeline on synthetic micrographs and print the results as JSON'
+
+STAGES = ['mrc', 'load', 'normalize', 'denoise', 'models', 'train']
+
+# constructors of the model classes in denoise.py, as denoise_cmd.py builds them
+MODELS = {
+    'UDenoiseNet': lambda dn: dn.UDenoiseNet(),
+    'UDenoiseNetSmall': lambda dn: dn.UDenoiseNetSmall(),
+    'UDenoiseNetMaxpool': lambda dn: dn.UDenoiseNetMaxpool(),
+    'UDenoiseNetBiasFree': lambda dn: dn.UDenoiseNetBiasFree(),
+    'UDenoiseNetNonPoolBiasFree': lambda dn: dn.UDenoiseNetNonPoolBiasFree(),
+    'UDenoiseNetPre': lambda dn: dn.UDenoiseNetPre(),
+    'DenoiseNet': lambda dn: dn.DenoiseNet(32),
+    'DenoiseNet2': lambda dn: dn.DenoiseNet2(64),
+    'DnCNN': lambda dn: dn.DnCNN(1),
+}
+
+
+def add_arguments(parser):
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to time (default: all)')
+    parser.add_argument('--sizes', nargs='+', default=['4096x4096', '5760x4092'],
+                        help='micrograph sizes as WIDTHxHEIGHT (default: 4096x4096 5760x4092)')
+    parser.add_argument('--patches', nargs='+', default=['1024:128', '2048:128', '512:64'],
+                        help='patch sizes and paddings of the patch-wise denoising as PATCH:PADDING (default: 1024:128 2048:128 512:64)')
+    parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS),
+                        help='model classes to time (default: all)')
+    parser.add_argument('--model-size', type=int, default=1024,
+                        help='side of the square image the model classes are timed on (default: 1024)')
+    parser.add_argument('--train-crop', type=int, default=256, help='crop size of the training step (default: 256)')
+    parser.add_argument('--train-batch-size', type=int, default=4, help='batch size of the training step (default: 4)')
+    parser.add_argument('--train-steps', type=int, default=5, help='training steps per timed run (default: 5)')
+    parser.add_argument('--pixel-cutoff', type=float, default=3, help='outlier cutoff of the normalization (default: 3)')
+
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='timed runs per measurement, after one warmup run (default: 3)')
+    parser.add_argument('-d', '--device', default=-1, help='which device to use, set to -1 to force CPU (default: -1)')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file (default: stdout)')
+    return parser
+
+
+def parse_size(size):
+    width, height = size.lower().split('x')
+    return int(height), int(width)
+
+
+def synthetic_micrograph(shape, seed=0):
+    # smooth "particles" under Gaussian noise, on the pixel scale of a raw micrograph
+    import numpy as np
+    from utils.image import gaussian_filter
+    rng = np.random.RandomState(seed)
+    signal = gaussian_filter(rng.randn(*shape).astype(np.float32), 8)
+    signal *= 5/signal.std()
+    noise = rng.randn(*shape).astype(np.float32)
+    noise *= 4
+    return signal + noise + 100
+
+
+class Timer:
+    def __init__(self, repeats=3, use_cuda=False):
+        self.repeats = repeats
+        self.use_cuda = use_cuda
+        self.results = []
+
+    def sync(self):
+        if self.use_cuda:
+            import torch
+            torch.cuda.synchronize()
+
+    def time(self, stage, fn, setup=None, shape=None, pixels=None, repeats=None, **params):
+        """ Time fn(*setup()) once for warmup and then repeats times, setup is not timed. """
+        repeats = repeats or self.repeats
+        times = []
+        for i in range(repeats + 1):
+            args = setup() if setup is not None else ()
+            self.sync()
+            tic = time.time()
+            fn(*args)
+            self.sync()
+            if i > 0:
+                times.append(time.time() - tic)
+        times.sort()
+        result = {'stage': stage, 'params': params, 'repeats': repeats
+                  , 'median_s': times[len(times) // 2], 'min_s': times[0]}
+        if shape is not None:
+            result['shape'] = list(shape)
+            pixels = pixels or shape[-2] * shape[-1]
+        if pixels is not None:
+            result['mpx_per_s'] = pixels / 1e6 / result['median_s']
+        self.results.append(result)
+
+        description = ' '.join('{}={}'.format(k, v) for k, v in sorted(params.items()))
+        print('# {:<10} {:<12} {:<40} {:8.4f}s'.format(stage, 'x'.join(map(str, shape or [])), description
+                                                        , result['median_s']), file=sys.stderr)
+        return result
+
+
+def environment(use_cuda):
+    import platform
+    import subprocess
+    import numpy as np
+    import torch
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))
+                                         , stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        commit = None
+    return {'commit': commit, 'time': time.time(), 'python': platform.python_version(), 'numpy': np.__version__
+           , 'torch': torch.__version__, 'threads': torch.get_num_threads(), 'cpu': platform.processor() or platform.machine()
+           , 'device': torch.cuda.get_device_name(0) if use_cuda else 'cpu'}
+
+
+def bench_mrc(timer, mic):
+    import io
+    import mrc
+
+    for dtype in ['float32', 'float16']:
+        timer.time('mrc_write', lambda: mrc.write_tiled(io.BytesIO(), mic, dtype=dtype), shape=mic.shape, dtype=dtype)
+        f = io.BytesIO()
+        mrc.write_tiled(f, mic, dtype=dtype)
+        content = f.getvalue()
+        timer.time('mrc_parse', lambda: mrc.parse(content), shape=mic.shape, dtype=dtype)
+    # the old writer, which converts and measures the whole array at once
+    timer.time('mrc_write', lambda: mrc.write(io.BytesIO(), mic[None]), shape=mic.shape, dtype='float32', writer='write')
+
+
+def bench_load(timer, mic, directory):
+    from utils.image import save_image
+    from utils.data.loader import load_image
+
+    for ext in ['mrc', 'mrc.gz']:
+        path = os.path.join(directory, 'bench.' + ext)
+        save_image(mic, path)
+        timer.time('load_image', lambda: load_image(path), shape=mic.shape, format=ext)
+        os.remove(path)
+
+
+def bench_normalize(timer, mic, cutoff):
+    from utils.image import standardize
+
+    # standardize copies an array it cannot write to first
+    readonly = mic.view()
+    readonly.flags.writeable = False
+
+    def reference(x):
+        # the normalization before it was fused into one pass
+        mu = x.mean()
+        std = x.std()
+        x = (x - mu) / std
+        x[(x < -cutoff) | (x > cutoff)] = 0
+        return x
+
+    timer.time('normalize', reference, setup=lambda: (mic.copy(),), shape=mic.shape, method='reference', cutoff=cutoff)
+    timer.time('normalize', lambda x: standardize(x, cutoff=cutoff), setup=lambda: (mic.copy(),), shape=mic.shape
+               , method='fused', cutoff=cutoff)
+    timer.time('normalize', lambda: standardize(readonly, cutoff=cutoff), shape=mic.shape, method='fused_copy'
+               , cutoff=cutoff)
+
+
+def bench_denoise(timer, model, mic, patches, use_cuda):
+    import torch
+    import denoise as dn
+    from utils.image import standardize
+
+    x, _, _ = standardize(mic.copy())
+    x = torch.from_numpy(x)
+    if use_cuda:
+        x = x.cuda()
+    shape = mic.shape
+    timer.time('denoise', lambda: dn.denoise(model, x), shape=shape, method='whole')
+    for patch_size, padding in patches:
+        timer.time('denoise', lambda: dn.denoise_patches(model, x, patch_size, padding=padding), shape=shape
+                   , method='patches', patch_size=patch_size, padding=padding)
+
+
+def bench_train(timer, args, directory, use_cuda):
+    import numpy as np
+    import denoise as dn
+    from utils.image import save_image
+
+    # pairs of independent noisy images of one signal, and the guidance image
+    size = 2 * args.train_crop
+    signal = synthetic_micrograph((size, size), seed=1) - 100
+    rng = np.random.RandomState(2)
+    paths = {}
+    for key in ['a', 'b', 'g']:
+        paths[key] = []
+        for i in range(args.train_batch_size):
+            path = os.path.join(directory, 'train_{}{}.mrc'.format(key, i))
+            noise = 0 if key == 'g' else 4 * rng.randn(size, size).astype(np.float32)
+            save_image(signal + noise, path)
+            paths[key].append(path)
+    dataset = dn.PairedImages(paths['a'], paths['b'], paths['g'], crop=args.train_crop, xform=True, preload=True)
+
+    model = dn.UDenoiseNet()
+    if use_cuda:
+        model.cuda()
+    # one period of train_steps steps per timed run, the first period is the warmup
+    steps = args.train_steps
+    training = dn.train_noise2noise(model, dataset, batch_size=args.train_batch_size, steps=steps * (args.repeats + 1)
+                                    , val_every=steps, use_cuda=use_cuda, shuffle=True)
+    timer.time('train_step', lambda: next(training), shape=(args.train_crop, args.train_crop)
+               , pixels=args.train_crop ** 2 * args.train_batch_size * steps, model='UDenoiseNet'
+               , batch_size=args.train_batch_size, steps=steps)
+    timer.results[-1]['step_s'] = timer.results[-1]['median_s'] / steps
+
+
+def main(args):
+    import shutil
+    import tempfile
+    import torch
+    import cuda
+    import denoise as dn
+    from utils.image import standardize
+
+    torch.manual_seed(0)
+    use_cuda = cuda.set_device(args.device)
+    timer = Timer(repeats=args.repeats, use_cuda=use_cuda)
+    patches = [tuple(int(v) for v in p.split(':')) for p in args.patches]
+    directory = tempfile.mkdtemp(prefix='said_bench_')
+
+    try:
+        for size in args.sizes:
+            shape = parse_size(size)
+            mic = synthetic_micrograph(shape)
+            print('# micrograph {}x{}'.format(shape[1], shape[0]), file=sys.stderr)
+
+            if 'mrc' in args.stages:
+                bench_mrc(timer, mic)
+            if 'load' in args.stages:
+                bench_load(timer, mic, directory)
+            if 'normalize' in args.stages:
+                bench_normalize(timer, mic, args.pixel_cutoff)
+            if 'denoise' in args.stages:
+                model = dn.UDenoiseNet().eval()
+                if use_cuda:
+                    model.cuda()
+                bench_denoise(timer, model, mic, patches, use_cuda)
+
+        if 'models' in args.stages:
+            s = args.model_size
+            x, _, _ = standardize(synthetic_micrograph((s, s)))
+            x = torch.from_numpy(x)
+            if use_cuda:
+                x = x.cuda()
+            for model_name in args.models:
+                model = MODELS[model_name](dn).eval()
+                if use_cuda:
+                    model.cuda()
+                try:
+                    timer.time('model', lambda: dn.denoise(model, x), shape=(s, s), model=model_name)
+                except Exception as e:
+                    # a model that cannot run is reported and the others are still timed
+                    print('# {} failed: {}'.format(model_name, e), file=sys.stderr)
+                    timer.results.append({'stage': 'model', 'params': {'model': model_name}, 'shape': [s, s]
+                                          , 'error': str(e)})
+
+        if 'train' in args.stages:
+            bench_train(timer, args, directory, use_cuda)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {'environment': environment(use_cuda), 'results': timer.results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('# wrote', args.output, file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import subprocess
+
+name = 'bench_startup'
+help = 'measure the startup time of the command line tools and fail if importing them loads torch or numpy'
+
+# modules that must not be loaded by importing a command module or by -h
+HEAVY = ['torch', 'numpy', 'h5py', 'PIL', 'scipy', 'denoise']
+COMMANDS = ['denoise_cmd', 'prune_cmd', 'registry_cmd', 'make_hdf_cmd', 'serve_cmd', 'submit_cmd', 'shard_cmd', 'bench_pipeline']
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def add_arguments(parser):
+    parser.add_argument('commands', nargs='*', default=COMMANDS, help='command modules to check (default: all)')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='number of timed runs per command (default: 5)')
+    parser.add_argument('--max-time', type=float, default=1.0,
+                        help='fail if the median time of -h exceeds the bare interpreter startup by more than this many seconds (default: 1.0)')
+    return parser
+
+
+def heavy_imports(module):
+    # import the module in a fresh interpreter and report which heavy modules came with it
+    code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(module, HEAVY)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return out.decode().split()
+
+
+def run_time(args, repeats=5):
+    # median wall time of running the interpreter with these arguments, the exit code is ignored
+    # so argument errors can be timed too
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeats):
+            tic = time.time()
+            subprocess.call([sys.executable] + args, cwd=ROOT, stdout=devnull, stderr=devnull)
+            times.append(time.time() - tic)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main(args):
+    failed = False
+
+    base = run_time(['-c', 'pass'], repeats=args.repeats)
+    print('# {:<14} {:>10} {:>12} {}'.format('command', '-h (s)', 'bad arg (s)', 'heavy imports'))
+    print('# {:<14} {:>10.3f} {:>12} {}'.format('python', base, '', ''))
+
+    for module in args.commands:
+        loaded = heavy_imports(module)
+        script = module + '.py'
+        t_help = run_time([script, '-h'], repeats=args.repeats)
+        t_error = run_time([script, '--no-such-option'], repeats=args.repeats)
+        print('# {:<14} {:>10.3f} {:>12.3f} {}'.format(module, t_help, t_error, ' '.join(loaded) or '-'))
+
+        if loaded:
+            print('# FAIL: importing {} loads {}'.format(module, ', '.join(loaded)), file=sys.stderr)
+            failed = True
+        if t_help - base > args.max_time:
+            print('# FAIL: {} -h takes {:.3f}s over the interpreter startup'.format(module, t_help - base), file=sys.stderr)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
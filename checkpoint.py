@@ -0,0 +1,169 @@
+from __future__ import print_function, division
+
+import os
+import re
+import glob
+import random
+import threading
+import queue
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """ Copy every tensor in a (nested) state dict to CPU memory, detached from training. """
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            return obj.detach().cpu()
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    # the numpy state is stored as plain python types so checkpoints load with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate()
+            , 'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian)
+            , 'torch': torch.get_rng_state()
+            }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    python = state['python']
+    random.setstate((python[0], tuple(python[1]), python[2]))
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def offset_rng_state(offset):
+    # reseed every generator from the current torch state plus offset, so processes that restored the
+    # same state draw different numbers
+    seed = (int(torch.randint(2**31, (1,))) + offset) % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu')
+
+
+def model_state(checkpoint):
+    """ Model parameters from either a checkpoint dict with a 'model' entry or a bare state dict. """
+    if 'model' in checkpoint:
+        return checkpoint['model']
+    return checkpoint
+
+
+class Checkpointer:
+    """
+    Writes training checkpoints from a background thread.
+
+    save() only snapshots the state into CPU memory, serialization happens on the writer thread.
+    Files are written to a temporary path and renamed into place, so a crash never leaves a
+    truncated checkpoint behind. If keep > 0, only the most recent keep checkpoints are retained.
+    Checkpoints are indexed by epoch or, for iteration-based training, by step (unit='step').
+    The best checkpoint is written to a fixed path that retention never removes. A header describing
+    the model architecture is stored with every checkpoint. Checkpoints already at the prefix, e.g.
+    from before a resume, count towards keep, in the order of their epoch or step.
+    """
+
+    def __init__(self, prefix, digits=3, keep=0, unit='epoch', header=None):
+        self.prefix = prefix
+        self.digits = digits
+        self.keep = keep
+        self.unit = unit
+        self.header = header
+
+        self.written = self.existing()
+        self.error = None
+
+        # at most one snapshot waits while another is being written, bounding the extra memory
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def path(self, index):
+        return self.prefix + ('model_' + self.unit + '{:0' + str(self.digits) + '}.sav').format(index)
+
+    def existing(self):
+        pattern = re.compile(re.escape(self.prefix + 'model_' + self.unit) + r'(\d+)\.sav$')
+        found = []
+        for path in glob.glob(glob.escape(self.prefix) + 'model_' + self.unit + '*.sav'):
+            match = pattern.match(path)
+            if match is not None:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def best_path(self):
+        return self.prefix + 'model_best.sav'
+
+    def save(self, index, model, optim, gamma=None, scheduler=None, tracker=None, periodic=True, best=False):
+        if self.error is not None:
+            raise self.error
+
+        state = {'header': self.header
+                , self.unit: index
+                , 'model': to_cpu(model.state_dict())
+                , 'optimizer': to_cpu(optim.state_dict())
+                , 'gamma': gamma
+                , 'scheduler': scheduler.state_dict() if scheduler is not None else None
+                , 'tracker': tracker.state_dict() if tracker is not None else None
+                , 'rng': get_rng_state()
+                }
+        # one snapshot serves both files
+        if periodic:
+            self.queue.put((self.path(index), state, True))
+        if best:
+            self.queue.put((self.best_path(), state, False))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, state, rotate = item
+            try:
+                self.write(path, state, rotate=rotate)
+            except Exception as e:
+                self.error = e
+
+    def write(self, path, state, rotate=True):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        tmp = path + '.tmp'
+        torch.save(state, tmp)
+        os.replace(tmp, path)
+
+        if not rotate:
+            return
+        # a resumed run may write an index again
+        if path in self.written:
+            self.written.remove(path)
+        self.written.append(path)
+        if self.keep > 0:
+            while len(self.written) > self.keep:
+                old = self.written.pop(0)
+                if os.path.exists(old):
+                    os.remove(old)
+
+    def close(self):
+        # wait for pending checkpoints to finish writing
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
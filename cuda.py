@@ -17,7 +17,8 @@ class CudaWarning(UserWarning):
 def set_device(device, error=False, warn=True):
     use_cuda = False
     # print(device)
-    if int(device[0]) >= 0: # try to set GPU when device >= 0
+    device = str(device) # comma separated list of GPUs, e.g. 0,1
+    if int(device.split(',')[0]) >= 0: # try to set GPU when device >= 0
         # device = int(device)
         os.environ["CUDA_VISIBLE_DEVICES"] = device
         use_cuda = torch.cuda.is_available()
@@ -1,6 +1,11 @@
 from __future__ import print_function, division
 
+import os
 import sys
+import time
+import random
+import itertools
+import contextlib
 import numpy as np
 
 import torch
@@ -8,56 +13,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data
 
+import parallel
+from checkpoint import set_rng_state, offset_rng_state
 from utils.data.loader import load_image
-from loss import gradient                   # 20221017 Modified by Zhidong Yang
+from utils.image import standardize
+from utils.data.sampler import InfiniteSampler
+from loss import gradient, gradient_sparsity  # 20221017 Modified by Zhidong Yang
 
 USE_CUDA = torch.cuda.is_available()
 device_m = torch.device("cuda:0" if USE_CUDA else "cpu")
 
 
-def load_model(name):
-    if name == 'none':
-        return Identity()
-
-    # set the name aliases
-    if name == 'unet':
-        name = 'unet_L2_v0.2.2.sav'
-    elif name == 'unet-small':
-        name = 'unet_small_L1_v0.2.2.sav'
-    elif name == 'fcnn':
-        name = 'fcnn_L1_v0.2.2.sav'
-    elif name == 'affine':
-        name = 'affine_L1_v0.2.2.sav'
-    elif name == 'unet-v0.2.1':
-        name = 'unet_L2_v0.2.1.sav'
-
-    # construct model and load the state
-    if name == 'unet_L2_v0.2.1.sav':
-        model = UDenoiseNet(base_width=7, top_width=3)
-    elif name == 'unet_L2_v0.2.2.sav':
-        model = UDenoiseNet(base_width=11, top_width=5)
-    elif name == 'unet_small_L1_v0.2.2.sav':
-        model = UDenoiseNetSmall(width=11, top_width=5)
-    elif name == 'fcnn_L1_v0.2.2.sav':
-        model = DenoiseNet2(64, width=11)
-    elif name == 'affine_L1_v0.2.2.sav':
-        model = AffineDenoise(max_size=31)
-    else:
-        # if not set to a pretrained model, try loading path directly
-        return torch.load(name)
-
-    # load the pretrained model parameters
-    import pkg_resources
-    pkg = __name__
-    path = 'pretrained/denoise/' + name
-    f = pkg_resources.resource_stream(pkg, path)
-    state_dict = torch.load(f)  # load the parameters
-
-    model.load_state_dict(state_dict)
-
-    return model
-
-
 def denoise(model, x, patch_size=-1, padding=128):
     # check the patch plus padding size
     use_patch = False
@@ -101,6 +67,56 @@ def denoise_patches(model, x, patch_size, padding=128):
     return y
 
 
+def tile_windows(shape, patch_size, padding=128):
+    """
+    Windows (si, ei, sj, ej) read for every patch of an image and the patch origins (i, j), the same
+    tiling as denoise and denoise_patches. An image that fits in one padded patch is a single window.
+    """
+    n, m = shape
+    s = patch_size + padding
+    if patch_size <= 0 or (s >= n and s >= m):
+        return [((0, n, 0, m), (0, 0))]
+    windows = []
+    for i in range(0, n, patch_size):
+        for j in range(0, m, patch_size):
+            si = max(0, i - padding)
+            ei = min(n, i + patch_size + padding)
+            sj = max(0, j - padding)
+            ej = min(m, j + patch_size + padding)
+            windows.append(((si, ei, sj, ej), (i, j)))
+    return windows
+
+
+def denoise_batch(model, images, patch_size=-1, padding=128, batch_size=8):
+    """
+    Denoise a list of 2d images. Images are tiled like in denoise and patches of the same shape, also
+    from different images, go through the model together in batches of up to batch_size.
+    """
+    outputs = [torch.zeros_like(x) for x in images]
+    if patch_size <= 0:
+        patch_size = max(max(x.shape) for x in images) if len(images) > 0 else 1
+
+    groups = {}
+    for k, x in enumerate(images):
+        for window, origin in tile_windows(x.shape, patch_size, padding=padding):
+            si, ei, sj, ej = window
+            groups.setdefault((ei - si, ej - sj), []).append((k, window, origin))
+
+    with torch.no_grad():
+        for tiles in groups.values():
+            for b in range(0, len(tiles), batch_size):
+                chunk = tiles[b:b + batch_size]
+                x = torch.stack([images[k][si:ei, sj:ej] for k, (si, ei, sj, ej), _ in chunk]).unsqueeze(1)
+                y = model(x)[:, 0]
+                for (k, (si, ei, sj, ej), (i, j)), yk in zip(chunk, y):
+                    # match back without the padding
+                    di = i - si
+                    dj = j - sj
+                    outputs[k][i:i + patch_size, j:j + patch_size] = yk[di:di + patch_size, dj:dj + patch_size]
+
+    return outputs
+
+
 class DnCNN(nn.Module):
     def __init__(self, channels, num_of_layers=10):
         super(DnCNN, self).__init__()
@@ -522,6 +538,83 @@ class UDenoiseNet(nn.Module):
         return y
 
 
+class UDenoiseNetSmall(nn.Module):
+    # small U-net for fast preview denoising, e.g. as a distillation student of UDenoiseNet.
+    # three stride-2 levels instead of five and nf=16, the full resolution block is narrowed too
+    def __init__(self, nf=16, width=11, top_width=3):
+        super(UDenoiseNetSmall, self).__init__()
+
+        self.enc1 = nn.Sequential(nn.Conv2d(1, nf, width, stride=2, padding=width // 2)
+                                  , nn.BatchNorm2d(nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+        self.enc2 = nn.Sequential(nn.Conv2d(nf, nf, 3, stride=2, padding=1)
+                                  , nn.BatchNorm2d(nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+        self.enc3 = nn.Sequential(nn.Conv2d(nf, nf, 3, stride=2, padding=1)
+                                  , nn.BatchNorm2d(nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+        self.enc4 = nn.Sequential(nn.Conv2d(nf, nf, 3, padding=1)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+
+        self.dec3 = nn.Sequential(nn.Conv2d(2 * nf, 2 * nf, 3, padding=1)
+                                  , nn.BatchNorm2d(2 * nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  , nn.Conv2d(2 * nf, 2 * nf, 3, padding=1)
+                                  , nn.BatchNorm2d(2 * nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+        self.dec2 = nn.Sequential(nn.Conv2d(3 * nf, 2 * nf, 3, padding=1)
+                                  , nn.BatchNorm2d(2 * nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  , nn.Conv2d(2 * nf, 2 * nf, 3, padding=1)
+                                  , nn.BatchNorm2d(2 * nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  )
+        self.dec1 = nn.Sequential(nn.Conv2d(2 * nf + 1, 2 * nf, top_width, padding=top_width // 2)
+                                  , nn.BatchNorm2d(2 * nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  , nn.Conv2d(2 * nf, nf, top_width, padding=top_width // 2)
+                                  , nn.BatchNorm2d(nf, affine=True)
+                                  , nn.LeakyReLU(0.1)
+                                  , nn.Conv2d(nf, 1, top_width, padding=top_width // 2)
+                                  )
+
+    def forward(self, x):
+        # downsampling
+        p1 = self.enc1(x)
+        p2 = self.enc2(p1)
+        p3 = self.enc3(p2)
+        h = self.enc4(p3)
+
+        # upsampling
+        n = p2.size(2)
+        m = p2.size(3)
+        h = F.interpolate(h, size=(n, m), mode='nearest')
+        h = torch.cat([h, p2], 1)
+
+        h = self.dec3(h)
+
+        n = p1.size(2)
+        m = p1.size(3)
+        h = F.interpolate(h, size=(n, m), mode='nearest')
+        h = torch.cat([h, p1], 1)
+
+        h = self.dec2(h)
+
+        n = x.size(2)
+        m = x.size(3)
+        h = F.interpolate(h, size=(n, m), mode='nearest')
+        h = torch.cat([h, x], 1)
+
+        y = self.dec1(h)
+
+        return y
+
+
 class UDenoiseNetBiasFree(nn.Module):
     # U-net modified from noise2noise paper
     # bias is removed
@@ -746,6 +839,84 @@ class UDenoiseNetPre(nn.Module):
         return y
 
 
+ARCHITECTURES = {'UDenoiseNet': UDenoiseNet
+                 , 'UDenoiseNetMaxpool': UDenoiseNetMaxpool
+                 , 'UDenoiseNetPre': UDenoiseNetPre
+                 , 'UDenoiseNetBiasFree': UDenoiseNetBiasFree
+                 , 'UDenoiseNetNonPoolBiasFree': UDenoiseNetNonPoolBiasFree
+                 , 'UDenoiseNetSmall': UDenoiseNetSmall
+                 , 'DenoiseNet2': DenoiseNet2
+                 , 'DnCNN': DnCNN
+                 }
+
+CHECKPOINT_FORMAT = 'said-model-v1'
+
+
+def detect_architecture(state):
+    """
+    Model class name and constructor arguments of a state dict, read from its keys and parameter shapes.
+
+    UDenoiseNet and UDenoiseNetNonPoolBiasFree have the same parameters, they are told apart by the width
+    of the first kernel the training command uses for each (11 and 7). UDenoiseNetPre is identical to
+    UDenoiseNetMaxpool. Checkpoints with an architecture header do not need to be guessed.
+    """
+    state = {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state.items()}
+
+    if 'enc1.0.weight' in state and 'dec1.0.weight' in state:
+        weight = state['enc1.0.weight']
+        nf = weight.shape[0]
+        base_width = weight.shape[-1]
+        top_width = state['dec1.0.weight'].shape[-1]
+        if 'enc5.0.weight' not in state:
+            return 'UDenoiseNetSmall', {'nf': nf, 'width': base_width, 'top_width': top_width}
+
+        kwargs = {'nf': nf, 'base_width': base_width, 'top_width': top_width}
+        if 'enc1.1.running_mean' not in state:
+            return 'UDenoiseNetMaxpool', kwargs
+        if 'enc1.0.bias' not in state:
+            return 'UDenoiseNetBiasFree', kwargs
+        if base_width == 7:
+            return 'UDenoiseNetNonPoolBiasFree', kwargs
+        return 'UDenoiseNet', kwargs
+
+    if 'dncnn.0.weight' in state:
+        convs = [k for k, v in state.items() if k.startswith('dncnn.') and k.endswith('.weight') and v.dim() == 4]
+        return 'DnCNN', {'channels': state['dncnn.0.weight'].shape[1], 'num_of_layers': len(convs)}
+
+    if 'net.4.weight' in state and 'net.5.weight' not in state and 'net.6.weight' not in state:
+        weight = state['net.0.weight']
+        return 'DenoiseNet2', {'base_filters': weight.shape[0], 'width': weight.shape[-1]}
+
+    raise Exception('Cannot detect the model architecture from the checkpoint parameters')
+
+
+def architecture_header(model):
+    # metadata saved with new checkpoints, so loading them does not depend on detect_architecture
+    model = getattr(model, 'module', model)
+    name = type(model).__name__
+    if name not in ARCHITECTURES:
+        return None
+    _, kwargs = detect_architecture(model.state_dict())
+    return {'format': CHECKPOINT_FORMAT, 'arch': name, 'kwargs': kwargs}
+
+
+def model_from_checkpoint(checkpoint):
+    """
+    Construct the model a checkpoint was saved from, without loading its parameters. Uses the architecture
+    header when the checkpoint has one and detect_architecture otherwise.
+    """
+    header = checkpoint.get('header') if 'model' in checkpoint else None
+    if header is not None:
+        name = header['arch']
+        kwargs = header['kwargs']
+    else:
+        state = checkpoint['model'] if 'model' in checkpoint else checkpoint
+        name, kwargs = detect_architecture(state)
+    if name not in ARCHITECTURES:
+        raise Exception('Unknown model architecture in checkpoint: ' + str(name))
+    return ARCHITECTURES[name](**kwargs)
+
+
 # 20221017 Modified by Zhidong Yang
 class PairedImages:
     def __init__(self, x, y, g, crop=800, xform=True, preload=False, cutoff=0):
@@ -761,17 +932,10 @@ class PairedImages:
         if preload:
             self.x = [self.load_image(p) for p in x]
             self.y = [self.load_image(p) for p in y]
-            self.g = [self.load_image(p) for p in y]  # 20221017 Modified by Zhidong Yang
+            self.g = [self.load_image(p) for p in g]  # 20221017 Modified by Zhidong Yang
 
     def load_image(self, path):
-        x = np.array(load_image(path), copy=False)
-        x = x.astype(np.float32)  # make sure dtype is single precision
-        mu = x.mean()
-        std = x.std()
-        x = (x - mu) / std
-        if self.cutoff > 0:
-            x[(x < -self.cutoff) | (x > self.cutoff)] = 0
-        return x
+        return load_normalized(path, cutoff=self.cutoff)
 
     def __len__(self):
         return len(self.x)
@@ -839,16 +1003,10 @@ class NoiseImages:
 
         self.preload = preload
         if preload:
-            x = [self.load_image(p) for p in x]
+            self.x = [self.load_image(p) for p in x]
 
     def load_image(self, path):
-        x = np.array(load_image(path), copy=False)
-        mu = x.mean()
-        std = x.std()
-        x = (x - mu) / std
-        if self.cutoff > 0:
-            x[(x < -self.cutoff) | (x > self.cutoff)] = 0
-        return x
+        return load_normalized(path, cutoff=self.cutoff)
 
     def __len__(self):
         return len(self.x)
@@ -884,60 +1042,126 @@ class NoiseImages:
         return x
 
 
-class L0Loss:
-    def __init__(self, eps=1e-8, gamma=2):
-        self.eps = eps
-        self.gamma = gamma
+def load_normalized(path, cutoff=0):
+    # single precision, standardized in place in one pass over the statistics and one over the pixels
+    x = np.array(load_image(path), copy=False)
+    x, _, _ = standardize(x, cutoff=cutoff)
+    return x
 
-    def __call__(self, x, y):
-        return torch.mean((torch.abs(x - y) + self.eps) ** self.gamma)
 
+def teacher_output_path(cache_dir, path):
+    # micrographs in different directories may share a name, so the path is hashed into the file name
+    import hashlib
+    name, _ = os.path.splitext(os.path.basename(path))
+    key = hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_dir, name + '_' + key + '.npy')
 
-# 20221017 Modified by Zhidong Yang
-def eval_noise2noise(model, dataset, criteria, weight_guidance
-                     , weight_gradient, batch_size=10
-                     , use_cuda=False, num_workers=0):
-    data_iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size
-                                                , num_workers=num_workers)
 
-    n = 0
-    loss = 0
+def cache_teacher_outputs(teacher, paths, cache_dir, since=0, cutoff=0, use_cuda=False, patch_size=-1, padding=128):
+    """
+    Denoise each micrograph once with the teacher and cache the output as .npy in cache_dir, in the
+    normalized units of the training images. Cached outputs newer than both the micrograph and since
+    (the modification time of the teacher checkpoint) are reused. Returns the paths of the outputs.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    teacher.eval()
+    targets = []
+    computed = 0
+    for path in paths:
+        target = teacher_output_path(cache_dir, path)
+        if not os.path.exists(target) or os.path.getmtime(target) < max(since, os.path.getmtime(path)):
+            x = torch.from_numpy(load_normalized(path, cutoff=cutoff))
+            if use_cuda:
+                x = x.cuda()
+            y = denoise(teacher, x, patch_size=patch_size, padding=padding)
+            np.save(target + '.tmp.npy', y.float().cpu().numpy())
+            os.replace(target + '.tmp.npy', target)
+            computed += 1
+        targets.append(target)
+        print('# {} of {} teacher outputs ready'.format(len(targets), len(paths)), file=sys.stderr, end='\r')
+    print('', file=sys.stderr)
+    print('# computed {} and reused {} teacher outputs'.format(computed, len(paths) - computed), file=sys.stderr)
 
-    model.eval()
+    return targets
 
-    # 20221017 Modified by Zhidong Yang
-    with torch.no_grad():
-        for x1, x2, g1 in data_iterator:
-            if use_cuda:
-                x1 = x1.cuda(device=0)
-                x2 = x2.cuda(device=0)
 
-            x1 = x1.unsqueeze(1)
-            x2 = x2.unsqueeze(1)
+class DistillImages:
+    """ Random crops of noisy micrographs x with the matching crops of the cached teacher outputs y. """
 
-            y1 = model(x1)
+    def __init__(self, x, y, crop=800, xform=True, preload=False, cutoff=0):
+        self.x = x
+        self.y = y
+        self.crop = crop
+        self.xform = xform
+        self.cutoff = cutoff
 
-            # 20221017 Modified by Zhidong Yang
-            loss_ = None
-            if weight_gradient > 0:
-                y2 = model(x2)  # 20221017 Modified by Zhidong Yang
-                loss_ = criteria(y1, x2).item() + criteria(y2, x1).item()
-            else:
-                loss_ = criteria(y1, x2).item()
+        self.preload = preload
+        if preload:
+            self.x = [self.load_image(p) for p in x]
+            self.y = [np.load(p) for p in y]
 
-            b = x1.size(0)
-            n += b
-            delta = b * (loss_ - loss)
-            loss += delta / n
+    def load_image(self, path):
+        return load_normalized(path, cutoff=self.cutoff)
 
-    return loss
+    def load_target(self, path):
+        # memory mapped, a crop only reads the pages it overlaps
+        return np.load(path, mmap_mode='r')
 
+    def __len__(self):
+        return len(self.x)
 
-# 20221017 Modified by Zhidong Yang
-def train_noise2noise(model, dataset, lr=0.001, optim='adagrad', weight_guidance=0.1
-                      , weight_gradient=0.01, batch_size=10, num_epochs=100
-                      , criteria=nn.MSELoss(), dataset_val=None
-                      , use_cuda=False, num_workers=0, shuffle=True):
+    def __getitem__(self, i):
+        if self.preload:
+            x = self.x[i]
+            y = self.y[i]
+        else:
+            x = self.load_image(self.x[i])
+            y = self.load_target(self.y[i])
+
+        # randomly crop
+        if self.crop is not None:
+            size = self.crop
+
+            n, m = x.shape
+            i = np.random.randint(n - size + 1)
+            j = np.random.randint(m - size + 1)
+
+            x = x[i:i + size, j:j + size]
+            y = y[i:i + size, j:j + size]
+
+        # randomly flip
+        if self.xform:
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 0)
+                y = np.flip(y, 0)
+
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 1)
+                y = np.flip(y, 1)
+
+            k = np.random.randint(4)
+            x = np.rot90(x, k=k)
+            y = np.rot90(y, k=k)
+
+        x = np.ascontiguousarray(x)
+        y = np.ascontiguousarray(y, dtype=np.float32)
+
+        return x, y
+
+
+class L0Loss:
+    def __init__(self, eps=1e-8, gamma=2):
+        self.eps = eps
+        self.gamma = gamma
+
+    def __call__(self, x, y):
+        return torch.mean((torch.abs(x - y) + self.eps) ** self.gamma)
+
+
+def make_criteria(criteria):
+    # returns the loss and the initial L0 gamma, None if gamma is not annealed
     gamma = None
     if criteria == 'L0':
         gamma = 2
@@ -947,198 +1171,532 @@ def train_noise2noise(model, dataset, lr=0.001, optim='adagrad', weight_guidance
         criteria = nn.L1Loss()
     elif criteria == 'L2':
         criteria = nn.MSELoss()
+    return criteria, gamma
+
 
+def make_optimizer(model, optim, lr):
     if optim == 'adam':
         optim = torch.optim.Adam(model.parameters(), lr=lr)
     elif optim == 'adagrad':
         optim = torch.optim.Adagrad(model.parameters(), lr=lr)
     elif optim == 'sgd':
         optim = torch.optim.SGD(model.parameters(), lr=lr, nesterov=True, momentum=0.9)
+    return optim
+
+
+def make_scheduler(optim, schedule='constant', num_periods=100, step_size=30, factor=0.1, patience=10, min_lr=0):
+    # learning rate schedules are stepped once per period, an epoch or --val-every steps
+    if schedule == 'constant':
+        return None
+    elif schedule == 'cosine':
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max=num_periods, eta_min=min_lr)
+    elif schedule == 'step':
+        return torch.optim.lr_scheduler.StepLR(optim, step_size=step_size, gamma=factor)
+    elif schedule == 'plateau':
+        return torch.optim.lr_scheduler.ReduceLROnPlateau(optim, factor=factor, patience=patience, min_lr=min_lr)
+    raise Exception('Unknown learning rate schedule: ' + schedule)
+
+
+def step_scheduler(scheduler, loss):
+    if scheduler is None:
+        return
+    if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+        scheduler.step(loss)
+    else:
+        scheduler.step()
+
+
+class LossTracker:
+    """
+    Tracks the best loss seen at the end of each period. With patience > 0, training should stop once
+    the loss has not improved by more than min_delta for patience periods in a row.
+    """
+
+    def __init__(self, patience=0, min_delta=0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = float('inf')
+        self.best_index = None
+        self.bad_periods = 0
+
+    def update(self, loss, index):
+        if loss < self.best - self.min_delta:
+            self.best = loss
+            self.best_index = index
+            self.bad_periods = 0
+            return True
+        self.bad_periods += 1
+        return False
+
+    @property
+    def stop(self):
+        return self.patience > 0 and self.bad_periods >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'best_index': self.best_index, 'bad_periods': self.bad_periods}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.best_index = state['best_index']
+        self.bad_periods = state['bad_periods']
+
+
+def seed_worker(worker_id):
+    # torch seeds each loader worker differently, but not numpy and random, which draw the crops and flips
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def make_data_iterator(dataset, batch_size, shuffle=False, num_workers=0, infinite=False, skip=0):
+    # under torch.distributed each process iterates over its own shard of the dataset,
+    # an infinite iterator skips the first skip samples it would have drawn
+    sampler = None
+    if infinite:
+        sampler = InfiniteSampler(len(dataset), shuffle=shuffle, rank=parallel.get_rank()
+                                  , world_size=parallel.get_world_size(), start=skip)
+        shuffle = False
+    elif parallel.is_distributed():
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
     data_iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle
-                                                , num_workers=num_workers)
+                                                , sampler=sampler, num_workers=num_workers
+                                                , worker_init_fn=seed_worker)
+    return data_iterator, sampler
+
+
+def resume_training(resume, optim, criteria, gamma, steps=None, scheduler=None, tracker=None):
+    # restore the optimizer, L0 gamma, schedule and RNG states of a full checkpoint and return where
+    # training continues, the model parameters are restored by the caller
+    if resume is None:
+        return 1 if steps is None else 0
+
+    unit = 'epoch' if steps is None else 'step'
+    if unit not in resume:
+        raise Exception('Cannot resume {}-based training from this checkpoint'.format(unit))
+
+    optim.load_state_dict(resume['optimizer'])
+    if gamma is not None and resume['gamma'] is not None:
+        criteria.gamma = resume['gamma']
+    if scheduler is not None and resume.get('scheduler') is not None:
+        scheduler.load_state_dict(resume['scheduler'])
+    if resume.get('tracker') is not None:
+        tracker.load_state_dict(resume['tracker'])
+    set_rng_state(resume['rng'])
+    if parallel.get_world_size() > 1:
+        # the checkpoint holds the random state of rank 0, the other ranks branch off from it
+        offset_rng_state(parallel.get_rank())
+
+    if steps is None:
+        return resume['epoch'] + 1
+    return resume['step']
+
+
+class CropCurriculum:
+    """
+    Grows the training crop from start to crop over the first warmup periods, doubling its size at each
+    stage. The batch size is scaled with the crop area, so every stage uses roughly the same memory.
+    """
 
-    total = len(dataset)
+    def __init__(self, crop, batch_size, start=128, warmup=10):
+        self.crop = crop
+        self.batch_size = batch_size
+        self.warmup = warmup
+
+        self.sizes = []
+        size = start
+        while size < crop:
+            self.sizes.append(size)
+            size *= 2
+
+    def __call__(self, period):
+        # crop size and batch size of the period, counted from 0
+        if period >= self.warmup or len(self.sizes) == 0:
+            return self.crop, self.batch_size
+        size = self.sizes[period * len(self.sizes) // self.warmup]
+        batch_size = max(1, int(self.batch_size * (self.crop / size) ** 2))
+        return size, batch_size
+
+
+def training_schedule(dataset, batch_size, start, num_epochs=100, steps=None, val_every=1000
+                      , shuffle=True, num_workers=0, curriculum=None):
+    """
+    Split training into periods that each end with validation.
 
-    for epoch in range(1, num_epochs + 1):
-        model.train()
+    Without steps a period is one pass over the dataset (an epoch). With steps the data iterator draws
+    crops indefinitely and a period is val_every steps, so validation cost does not depend on the dataset
+    size. Yields (index, progress, batches, num_batches) where index is the epoch, or the step count at
+    the end of the period, and progress is the fraction of training done before the period.
 
-        n = 0
-        loss_accum = 0
+    With a curriculum, the crop size of the dataset and the batch size are set at the start of each period
+    and the data iterator is rebuilt whenever they change.
+    """
+    if curriculum is None:
+        curriculum = lambda period: (dataset.crop, batch_size)
+
+    def configure(setting):
+        crop, b = setting
+        if crop != dataset.crop and parallel.is_main_process():
+            print('# crop size {}, batch size {}'.format(crop, b), file=sys.stderr)
+        dataset.crop = crop
+
+    current = None
+    if steps is None:
+        for epoch in range(start, num_epochs + 1):
+            setting = curriculum(epoch - 1)
+            if setting != current:
+                configure(setting)
+                current = setting
+                data_iterator, sampler = make_data_iterator(dataset, setting[1], shuffle=shuffle
+                                                            , num_workers=num_workers)
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            yield epoch, (epoch - 1) / num_epochs, data_iterator, len(data_iterator)
+    else:
+        # samples this process has drawn so far, a new stream continues where the last one stopped
+        drawn = sum(curriculum(s // val_every)[1] for s in range(start))
+        step = start
+        while step < steps:
+            n = min(val_every - step % val_every, steps - step)
+            setting = curriculum(step // val_every)
+            if setting != current:
+                configure(setting)
+                current = setting
+                data_iterator, _ = make_data_iterator(dataset, setting[1], shuffle=shuffle
+                                                      , num_workers=num_workers, infinite=True, skip=drawn)
+                stream = iter(data_iterator)
+            yield step + n, step / steps, itertools.islice(stream, n), n
+            step += n
+            drawn += n * setting[1]
+
+
+def autocast(use_cuda, enabled=True):
+    # mixed precision context, float16 on GPU and bfloat16 on CPU
+    if not enabled:
+        return contextlib.nullcontext()
+    if use_cuda:
+        return torch.autocast('cuda', dtype=torch.float16, enabled=enabled)
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+
+def grad_scaler(enabled):
+    # loss scaling is only needed for float16, bfloat16 has the float32 exponent range
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def symmetric_forward(model, x1, x2):
+    # denoise both halves of the pair in a single forward over [x1; x2], so kernels run at twice
+    # the batch size and the weights are read once per step.
+    # BatchNorm layers in train mode normalize with the statistics of the joint batch and update
+    # their running estimates once per step rather than once per half, models without BatchNorm
+    # and models in eval mode give the same outputs as two separate passes.
+    b = x1.size(0)
+    y = model(torch.cat([x1, x2], 0))
+    return y[:b], y[b:]
+
+
+def noise2noise_loss(model, x1, x2, g1, criteria, weight_guidance=0, weight_gradient=0):
+    # every term is computed from one forward pass over the crop, in float32.
+    # g1 is the precomputed guidance crop aligned with x1 and x2, so the guidance
+    # term costs one extra criteria evaluation and no filtering. an empty g1 (a store
+    # without guidance images) skips the guidance term.
+    terms = {}
+    if g1.numel() == 0:
+        weight_guidance = 0
+    if weight_gradient > 0:
+        y1, y2 = symmetric_forward(model, x1, x2)
+        y1 = y1.float()
+        y2 = y2.float()
+        terms['noise2noise'] = criteria(y1, x2) + criteria(y2, x1)
+        if weight_guidance > 0:
+            terms['guidance'] = criteria(y1, g1) + criteria(y2, g1)
+        terms['gradient'] = gradient_sparsity(y1) + gradient_sparsity(y2)
+    else:
+        y1 = model(x1).float()
+        terms['noise2noise'] = criteria(y1, x2)
+        if weight_guidance > 0:
+            terms['guidance'] = criteria(y1, g1)
 
-        if gamma is not None:
-            # anneal gamma to 0
-            criteria.gamma = 2 - (epoch - 1) * 2 / num_epochs
+    loss = terms['noise2noise']
+    if 'guidance' in terms:
+        loss = loss + weight_guidance * terms['guidance']
+    if 'gradient' in terms:
+        loss = loss + weight_gradient * terms['gradient']
 
-        for x1, x2, g1 in data_iterator:
-            if use_cuda:
-                x1 = x1.cuda(device=0)
-                x2 = x2.cuda(device=0)          # 20221017 Modified by Zhidong Yang
-            x1 = x1.unsqueeze(1)
-            x2 = x2.unsqueeze(1)
+    return loss, terms
 
-            y1 = model(x1)
 
-            # 20221017 Modified by Zhidong Yang
-            loss = None
-            if weight_gradient > 0:
-                y2 = model(x2)
-                loss = criteria(y1, x2) + criteria(y2, x1)
-            else:
-                loss = criteria(y1, x2)
+def noise2noise_batch_loss(weight_guidance=0, weight_gradient=0):
+    # batch_loss for train_denoiser and eval_denoiser over (x1, x2, g1) batches of PairedImages
+    def batch_loss(model, batch, criteria):
+        x1, x2, g1 = [x.unsqueeze(1) for x in batch]
+        return noise2noise_loss(model, x1, x2, g1, criteria
+                                , weight_guidance=weight_guidance
+                                , weight_gradient=weight_gradient)
+    return batch_loss
 
-            loss.backward()
-            optim.step()
-            optim.zero_grad()
 
-            loss = loss.item()
-            b = x1.size(0)
+# 20221017 Modified by Zhidong Yang
+def eval_noise2noise(model, dataset, criteria, weight_guidance
+                     , weight_gradient, batch_size=10
+                     , use_cuda=False, num_workers=0, amp=False):
+    batch_loss = noise2noise_batch_loss(weight_guidance=weight_guidance, weight_gradient=weight_gradient)
+    return eval_denoiser(model, dataset, criteria, batch_loss, batch_size=batch_size, use_cuda=use_cuda
+                         , num_workers=num_workers, amp=amp)
 
-            n += b
-            delta = b * (loss - loss_accum)
-            loss_accum += delta / n
 
-            print('# [{}/{}] {:.2%} loss={:.5f}'.format(epoch, num_epochs, n / total, loss_accum)
-                  , file=sys.stderr, end='\r')
-        print(' ' * 80, file=sys.stderr, end='\r')
+# 20221017 Modified by Zhidong Yang
+def train_noise2noise(model, dataset, weight_guidance=0.1, weight_gradient=0.01, **kwargs):
+    # noise2noise training with the guidance and gradient terms, see train_denoiser for the remaining arguments
+    batch_loss = noise2noise_batch_loss(weight_guidance=weight_guidance, weight_gradient=weight_gradient)
+    return train_denoiser(model, dataset, batch_loss, **kwargs)
 
-        if dataset_val is not None:
-            loss_val = eval_noise2noise(model, dataset_val, criteria
-                                        , weight_guidance=weight_guidance
-                                        , weight_gradient=weight_gradient
-                                        , batch_size=batch_size
-                                        , num_workers=num_workers
-                                        , use_cuda=use_cuda
-                                        )
-            yield epoch, loss_accum, loss_val
-        else:
-            yield epoch, loss_accum
 
+def sample_mask(x, p, stratified=True):
+    """
+    Sample the blind-spot pixels of a B x H x W batch, on the device of x.
 
-'''
-def eval_mask_denoise(model, dataset, criteria, p=0.01 # masking rate
-                     , batch_size=10, use_cuda=False, num_workers=0):
-    data_iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size
-                                               , num_workers=num_workers)
+    Returns B x k flat pixel indices with k ~ p*H*W. With stratified sampling one pixel is drawn
+    from every cell of a grid with cell area ~1/p, otherwise k pixels are drawn uniformly.
+    """
+    b, n, m = x.shape
+    if stratified:
+        s = max(1, int(round(1 / np.sqrt(p))))
+        rows = torch.arange(0, n, s, device=x.device).view(1, -1, 1)
+        cols = torch.arange(0, m, s, device=x.device).view(1, 1, -1)
+        shape = (b, rows.size(1), cols.size(2))
+        rows = rows + torch.randint(s, shape, device=x.device)
+        cols = cols + torch.randint(s, shape, device=x.device)
+        # cells on the border may be cut by the image edge
+        rows = rows.clamp_(max=n - 1)
+        cols = cols.clamp_(max=m - 1)
+        index = (rows * m + cols).view(b, -1)
+    else:
+        k = max(1, int(round(p * n * m)))
+        index = torch.randint(n * m, (b, k), device=x.device)
+    return index
 
-    n = 0
-    loss = 0
 
-    model.eval()
+def mask_loss(model, x, criteria, p=0.01, stratified=True):
+    # replace the masked pixels by N(0,1) noise and score the prediction only at those pixels,
+    # no full-size mask or noise tensors are drawn
+    b = x.size(0)
+    index = sample_mask(x, p, stratified=stratified)
+    flat = x.reshape(b, -1)
+    r = torch.randn(index.size(), device=x.device, dtype=x.dtype)
+    x_ = flat.scatter(1, index, r).view_as(x)
 
-    with torch.no_grad():
-        for x in data_iterator:
-            # sample the mask
-            mask = (torch.rand(x.size()) < p)
-            r = torch.randn(x.size())
+    y = model(x_.unsqueeze(1)).float().reshape(b, -1)
 
-            if use_cuda:
-                x = x.cuda()
-                mask = mask.cuda()
-                r = r.cuda()
+    return criteria(y.gather(1, index), flat.gather(1, index).float())
 
-            # mask out x by replacing from N(0,1)
-            x_ = mask.float()*r + (1-mask.float())*x
 
-            # denoise the image
-            y = model(x_.unsqueeze(1)).squeeze(1)
+def cuda_batch(batch, use_cuda):
+    # a batch is a tensor or a list of tensors
+    if not use_cuda:
+        return batch
+    if torch.is_tensor(batch):
+        return batch.cuda()
+    return [x.cuda() for x in batch]
 
-            # calculate the loss for the masked entries
-            x = x[mask]
-            y = y[mask]
 
-            loss_ = criteria(y, x).item()
+def split_loss(out):
+    # batch_loss returns the loss, or the loss and a dict of its unweighted terms
+    if isinstance(out, tuple):
+        return out
+    return out, {}
 
-            b = x.size(0)
-            n += b
-            delta = b*(loss_ - loss)
-            loss += delta/n
 
-    return loss
+def eval_denoiser(model, dataset, criteria, batch_loss, batch_size=10, use_cuda=False, num_workers=0, amp=False):
+    # batch_loss(model, batch, criteria) scores one batch of the dataset
+    # under torch.distributed every process evaluates its own shard and the losses are reduced
+    data_iterator, _ = make_data_iterator(dataset, batch_size, num_workers=num_workers)
 
+    n = 0
+    loss = 0
 
-def train_mask_denoise(model, dataset, p=0.01, lr=0.001, optim='adagrad', batch_size=10, num_epochs=100
-                      , criteria=nn.MSELoss(), dataset_val=None
-                      , use_cuda=False, num_workers=0, shuffle=True):
+    model.eval()
 
-    gamma = None
-    if criteria == 'L0':
-        gamma = 2
-        eps = 1e-8
-        criteria = L0Loss(eps=eps, gamma=gamma)
-    elif criteria == 'L1':
-        criteria = nn.L1Loss()
-    elif criteria == 'L2':
-        criteria = nn.MSELoss()
+    with torch.no_grad():
+        for batch in data_iterator:
+            batch = cuda_batch(batch, use_cuda)
 
-    if optim == 'adam':
-        optim = torch.optim.Adam(model.parameters(), lr=lr)
-    elif optim == 'adagrad':
-        optim = torch.optim.Adagrad(model.parameters(), lr=lr)
-    elif optim == 'sgd':
-        optim = torch.optim.SGD(model.parameters(), lr=lr, nesterov=True, momentum=0.9)
-    data_iterator = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle
-                                               , num_workers=num_workers)
+            with autocast(use_cuda, enabled=amp):
+                loss_, _ = split_loss(batch_loss(model, batch, criteria))
+                loss_ = loss_.item()
+
+            b = len(batch[0]) if isinstance(batch, list) else batch.size(0)
+            n += b
+            delta = b*(loss_ - loss)
+            loss += delta/n
+
+    loss = parallel.all_reduce_mean(loss, n)
+
+    return loss
 
-    total = len(dataset)
 
-    for epoch in range(1, num_epochs+1):
+def eval_mask_denoise(model, dataset, criteria, p=0.01 # masking rate
+                      , stratified=True, batch_size=10, use_cuda=False, num_workers=0, amp=False):
+    batch_loss = lambda model, x, criteria: mask_loss(model, x, criteria, p=p, stratified=stratified)
+    return eval_denoiser(model, dataset, criteria, batch_loss, batch_size=batch_size, use_cuda=use_cuda
+                         , num_workers=num_workers, amp=amp)
+
+
+def train_denoiser(model, dataset, batch_loss, lr=0.001, optim='adagrad', batch_size=10, num_epochs=100
+                   , criteria=nn.MSELoss(), dataset_val=None
+                   , use_cuda=False, num_workers=0, shuffle=True, amp=False
+                   , checkpointer=None, resume=None
+                   , steps=None, val_every=1000, save_every=None
+                   , lr_schedule='constant', lr_step_size=30, lr_factor=0.1, lr_patience=10, min_lr=0
+                   , early_stop=0, min_delta=0, curriculum=None):
+    # training loop for methods scoring one batch at a time with batch_loss(model, batch, criteria),
+    # the batches are tensors or lists of tensors. batch_loss returns the loss, or the loss and a dict
+    # of its unweighted terms, which are reported per period.
+    # with steps set, training is iteration-based: validation runs every val_every steps and
+    # checkpoints are saved every save_every steps (default: at every validation).
+    # the learning rate schedule and early stopping follow the validation loss (the training loss
+    # without a validation set) at the end of each period, early_stop is the patience in periods
+    criteria, gamma = make_criteria(criteria)
+    optim = make_optimizer(model, optim, lr)
+
+    num_periods = num_epochs if steps is None else -(-steps // val_every)
+    scheduler = make_scheduler(optim, lr_schedule, num_periods=num_periods, step_size=lr_step_size
+                               , factor=lr_factor, patience=lr_patience, min_lr=min_lr)
+    tracker = LossTracker(patience=early_stop, min_delta=min_delta)
+
+    start = resume_training(resume, optim, criteria, gamma, steps=steps, scheduler=scheduler, tracker=tracker)
+    step = start if steps is not None else 0
+    if save_every is None:
+        save_every = val_every
+    last = num_epochs if steps is None else steps
+
+    scaler = grad_scaler(amp and use_cuda)
+    verbose = parallel.is_main_process()
+
+    schedule = training_schedule(dataset, batch_size, start, num_epochs=num_epochs, steps=steps
+                                 , val_every=val_every, shuffle=shuffle, num_workers=num_workers
+                                 , curriculum=curriculum)
+    for index, progress, batches, num_batches in schedule:
         model.train()
 
         n = 0
+        count = 0
         loss_accum = 0
+        term_sums = {}
+
+        # time spent waiting for data versus the rest of the step
+        epoch_start = time.time()
+        data_time = 0
 
         if gamma is not None:
             # anneal gamma to 0
-            criteria.gamma = 2 - (epoch-1)*2/num_epochs
-
-        for x in data_iterator:
-            b = x.size(0)
+            criteria.gamma = 2 - 2*progress
 
-            # sample the mask
-            mask = (torch.rand(x.size()) < p)
-            r = torch.randn(x.size())
+        tic = time.time()
+        for batch in batches:
+            data_time += time.time() - tic
 
-            if use_cuda:
-                x = x.cuda()
-                mask = mask.cuda()
-                r = r.cuda()
-
-            # mask out x by replacing from N(0,1)
-            x_ = mask.float()*r + (1-mask.float())*x
-
-            # denoise the image
-            y = model(x_.unsqueeze(1)).squeeze(1)
+            batch = cuda_batch(batch, use_cuda)
+            b = len(batch[0]) if isinstance(batch, list) else batch.size(0)
 
-            # calculate the loss for the masked entries
-            x = x[mask]
-            y = y[mask]
+            with autocast(use_cuda, enabled=amp):
+                loss, terms = split_loss(batch_loss(model, batch, criteria))
 
-            loss = criteria(y, x)
-
-            loss.backward()
-            optim.step()
-            optim.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optim)
+            scaler.update()
+            optim.zero_grad(set_to_none=True)
 
             loss = loss.item()
             n += b
+            count += 1
             delta = b*(loss - loss_accum)
             loss_accum += delta/n
+            for k, v in terms.items():
+                term_sums[k] = term_sums.get(k, 0) + b*v.item()
+
+            if steps is not None:
+                step += 1
+                # checkpoints at the end of a period are saved after validation
+                if checkpointer is not None and step % save_every == 0 and step < index:
+                    checkpointer.save(step, model, optim, gamma=(criteria.gamma if gamma is not None else None)
+                                      , scheduler=scheduler, tracker=tracker)
+
+            if verbose:
+                print('# [{}/{}] {:.2%} loss={:.5f}'.format(index, last, count/num_batches, loss_accum)
+                      , file=sys.stderr, end='\r')
+            tic = time.time()
+        if verbose:
+            print(' '*80, file=sys.stderr, end='\r')
+
+        loss_accum = parallel.all_reduce_mean(loss_accum, n)
+
+        if verbose:
+            # per-term losses (unweighted) and the time split of the period
+            epoch_time = time.time() - epoch_start
+            report = ''.join('{}={:.5f} '.format(k, v/n) for k, v in term_sums.items())
+            print('# [{}/{}] {}lr={:.3g} time={:.1f}s data={:.1f}s compute={:.1f}s'.format(
+                  index, last, report, optim.param_groups[0]['lr'], epoch_time, data_time, epoch_time - data_time)
+                  , file=sys.stderr)
 
-            print('# [{}/{}] {:.2%} loss={:.5f}'.format(epoch, num_epochs, n/total, loss_accum)
-                 , file=sys.stderr, end='\r')
-        print(' '*80, file=sys.stderr, end='\r')
+        if dataset_val is not None:
+            loss_val = eval_denoiser(model, dataset_val, criteria, batch_loss
+                                     , batch_size=batch_size
+                                     , num_workers=num_workers
+                                     , use_cuda=use_cuda
+                                     , amp=amp
+                                     )
+
+        monitor = loss_val if dataset_val is not None else loss_accum
+        improved = tracker.update(monitor, index)
+        step_scheduler(scheduler, monitor)
+
+        if checkpointer is not None:
+            # the best model so far is also kept as model_best.sav, which needs a validation set
+            periodic = steps is None or index % save_every == 0 or index == steps
+            best = improved and dataset_val is not None
+            if periodic or best:
+                checkpointer.save(index, model, optim, gamma=(criteria.gamma if gamma is not None else None)
+                                  , scheduler=scheduler, tracker=tracker, periodic=periodic, best=best)
 
         if dataset_val is not None:
-            loss_val = eval_mask_denoise(model, dataset_val, criteria, p=p
-                                        , batch_size=batch_size
-                                        , num_workers=num_workers
-                                        , use_cuda=use_cuda
-                                        )
-            yield epoch, loss_accum, loss_val
+            yield index, loss_accum, loss_val
         else:
-            yield epoch, loss_accum
+            yield index, loss_accum
+
+        if tracker.stop:
+            if verbose:
+                print('# stopping early, best loss {:.5f} at {} {}'.format(
+                      tracker.best, 'epoch' if steps is None else 'step', tracker.best_index), file=sys.stderr)
+            break
+
 
+def train_mask_denoise(model, dataset, p=0.01, stratified=True, **kwargs):
+    # blind-spot training, see train_denoiser for the remaining arguments
+    batch_loss = lambda model, x, criteria: mask_loss(model, x, criteria, p=p, stratified=stratified)
+    return train_denoiser(model, dataset, batch_loss, **kwargs)
 
+
+def distill_loss(model, batch, criteria):
+    # fit the student to the cached teacher outputs
+    x, y = batch
+    out = model(x.unsqueeze(1)).float()
+    return criteria(out, y.unsqueeze(1).float())
+
+
+def eval_distill(model, dataset, criteria, batch_size=10, use_cuda=False, num_workers=0, amp=False):
+    return eval_denoiser(model, dataset, criteria, distill_loss, batch_size=batch_size, use_cuda=use_cuda
+                         , num_workers=num_workers, amp=amp)
+
+
+def train_distill(model, dataset, **kwargs):
+    # knowledge distillation from DistillImages, see train_denoiser for the arguments
+    return train_denoiser(model, dataset, distill_loss, **kwargs)
+
+
+'''
 def lowpass(x, factor=1):
     """ low pass filter with FFT """
 
@@ -4,31 +4,25 @@ from __future__ import print_function, division
 import os
 import sys
 import glob
-
-import numpy as np
-# import pandas as pd
-
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-
-from utils.data.loader import load_image
-from utils.image import downsample
-import mrc as mrc
-import cuda
+import time
 import random
 
+# torch, numpy and the modules built on them are imported where they are used, so -h and argument
+# errors return without loading them. bench_startup.py checks that this stays the case
+
 name = 'denoise'
 help = 'denoise micrographs with various denoising algorithms'
 
 
-USE_CUDA = torch.cuda.is_available()
-device_m = torch.device("cuda:0" if USE_CUDA else "cpu")
-# device_m = torch.device("cuda:1" if USE_CUDA else "cpu")
-random.seed(1234)
-np.random.seed(1234)
-torch.manual_seed(1234)
-torch.cuda.manual_seed_all(1234)
+def seed_everything(seed=1234):
+    import numpy as np
+    import torch
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
 
 def add_arguments(parser):
     ## only describe the model
@@ -41,14 +35,54 @@ def add_arguments(parser):
     parser.add_argument('-o', '--output', help='directory to save denoised micrographs')
     parser.add_argument('--suffix', default='',
                         help='add this suffix to each output file name. if no output directory is specified, denoised micrographs are written to the same location as the input with a default suffix of ".denoised" (default: none)')
-    parser.add_argument('--format', dest='format_', default='mrc', help='output format for the images (default: mrc)')
+    parser.add_argument('--format', dest='format_', default='mrc',
+                        help='output format for the images, mrc.gz and mrc.xz write compressed MRC files (default: mrc)')
+    parser.add_argument('--mrc-dtype', choices=['float32', 'float16'], default='float32',
+                        help='data type of MRC outputs, float16 (mode 12) halves their size (default: float32)')
     parser.add_argument('--normalize', action='store_true', help='normalize the micrographs')
 
+    # quality control
+    parser.add_argument('--preview', choices=['png', 'jpg'],
+                        help='also write a downsampled preview of each denoised micrograph in this format, in the background')
+    parser.add_argument('--preview-size', type=int, default=512,
+                        help='longest side of the previews in pixels, Fourier binned, 0 keeps the full size (default: 512)')
+    parser.add_argument('--preview-dir', help='directory of the previews (default: preview in the output directory)')
+    parser.add_argument('--preview-workers', type=int, default=2, help='number of threads writing previews (default: 2)')
+
     parser.add_argument('--stack', action='store_true', help='denoise a MRC stack rather than list of micorgraphs')
 
+    # reruns
+    parser.add_argument('--skip-done', action='store_true',
+                        help='skip micrographs whose output was written by an earlier run with the same input, models and options')
+    parser.add_argument('--skip-hash', choices=['stat', 'content'], default='stat',
+                        help='detect changed inputs by their size and modification time, or by a hash of their content (default: stat)')
+    parser.add_argument('--manifest', help='file recording the written outputs for --skip-done (default: said_manifest.jsonl in the output directory)')
+
+    # splitting a job over several processes or nodes
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='split the micrographs, or the sections of a --stack, into this many shards balanced by pixel count (default: 1)')
+    parser.add_argument('--shard-index', type=int, default=0, help='which shard this process denoises, from 0 (default: 0)')
+    parser.add_argument('--shard-plan', help='take the micrographs of --shard-index from this plan written by shard_cmd.py --plan')
+
+    # streaming during data collection
+    parser.add_argument('--watch', help='denoise micrographs as they are written into this directory, until interrupted or --watch-timeout')
+    parser.add_argument('--watch-pattern', default='*.mrc', help='file name pattern of the watched micrographs (default: *.mrc)')
+    parser.add_argument('--settle', type=float, default=5,
+                        help='a watched file is complete once its size has not changed for this many seconds (default: 5)')
+    parser.add_argument('--poll-interval', type=float, default=2, help='seconds between scans of the watched directory (default: 2)')
+    parser.add_argument('--watch-timeout', type=float, default=0,
+                        help='stop watching after this many seconds without a new micrograph, 0 watches until interrupted (default: 0)')
+    parser.add_argument('--processed-log',
+                        help='file recording the processed micrographs, so a restarted watch skips them (default: said_processed.jsonl in the output directory, or the watched directory)')
+
     parser.add_argument('--save-prefix', help='path prefix to save denoising model')
+    parser.add_argument('--keep-checkpoints', type=int, default=0,
+                        help='only keep this many of the most recent checkpoints, 0 keeps all of them (default: 0)')
+    parser.add_argument('--resume', help='continue training from this checkpoint (model, optimizer, RNG state and epoch or step). '
+                                          'the crops and flips of a resumed run only match an uninterrupted run with --num-workers 0, '
+                                          'the random state of data loading workers is not saved')
     parser.add_argument('-m', '--model', nargs='+', default=['unet'],
-                        help='use pretrained denoising model(s). can accept arguments for multiple models the outputs of which will be averaged. pretrained model options are: unet, unet-small, fcnn, affine. to use older unet version specify unet-v0.2.1 (default: unet)')
+                        help='use trained denoising model(s), given as checkpoint paths or names in the model registry (see the registry command). can accept arguments for multiple models the outputs of which will be averaged. the topaz model names unet, unet-v0.2.1 and fcnn are registered by default (default: unet)')
 
     parser.add_argument('-a', '--dir-a', nargs='+', help='directory of training images part A')
     parser.add_argument('-b', '--dir-b', nargs='+', help='directory of training images part B')
@@ -59,11 +93,12 @@ def add_arguments(parser):
     # newly added 20221018 by Zhidong Yang
     parser.add_argument('-wgu', '--weight_guidance', type=float, default=0.5, help='weight for filtered guidance loss')
     parser.add_argument('-wgd', '--weight_gradient', type=float, default=0.01, help='weight for gradient sparsity loss')
-    parser.add_argument('-ret', '--retraining', choices=['finetune', 'abinit', 'abinitMaxpool', 'abinitBFNet', 'abinitBFNonMaxpool'], default='abinit', help='choice of fine tuning')
+    parser.add_argument('-ret', '--retraining', choices=['finetune', 'abinit', 'abinitMaxpool', 'abinitBFNet', 'abinitBFNonMaxpool'],
+                        help='choice of fine tuning (default: abinit). when denoising, the model class is detected from the checkpoint unless this is given')
 
     parser.add_argument('--hdf',
-                        help='path to HDF5 file containing training image stack as an alternative to dirA/dirB')
-    parser.add_argument('--preload', action='store_true', help='preload micrographs into RAM')
+                        help='path to chunked HDF5 training store (built with make_hdf_cmd.py) as an alternative to dirA/dirB')
+    parser.add_argument('--preload', action='store_true', help='preload micrographs, including the guidance images, into RAM once')
     parser.add_argument('--holdout', type=float, default=0.2,
                         help='fraction of training micrograph pairs to holdout for validation (default: 0.1)')
 
@@ -85,39 +120,81 @@ def add_arguments(parser):
                         help='denoises micrographs in patches of this size. not used if <1 (default: -1)')
     parser.add_argument('-p', '--patch-padding', type=int, default=512,
                         help='padding around each patch to remove edge artifacts (default: 500)')
-
-    parser.add_argument('--method', choices=['noise2noise', 'masked'], default='noise2noise',
-                        help='denoising training method (default: noise2noise)')
+    parser.add_argument('--denoise-batch-size', type=int, default=1,
+                        help='number of micrographs (or patches) of the same shape passed through the model together when denoising. speeds up many small micrographs (default: 1)')
+
+    parser.add_argument('--method', choices=['noise2noise', 'masked', 'distill'], default='noise2noise',
+                        help='denoising training method, masked trains from single noisy micrographs (-a, optionally -b) without pairs, distill fits --arch (e.g. unet-small) to the outputs of the --teacher model on the micrographs in -a (and -b) (default: noise2noise)')
+    parser.add_argument('--teacher', help='trained model to distill, its class is detected like for denoising')
+    parser.add_argument('--teacher-cache',
+                        help='directory to cache the teacher outputs in, outputs newer than the teacher checkpoint are reused (default: <teacher>_outputs next to the checkpoint)')
+    parser.add_argument('--mask-rate', type=float, default=0.01,
+                        help='fraction of pixels masked per image for the masked method (default: 0.01)')
+    parser.add_argument('--mask-sampling', choices=['grid', 'random'], default='grid',
+                        help='sample one masked pixel per grid cell or masked pixels uniformly at random (default: grid)')
     parser.add_argument('--arch', choices=['unet', 'unet-small', 'unet2', 'unet3', 'fcnet', 'fcnet2', 'affine', 'unet-maxpool', 'bfnet', 'bfnonmaxpool'],
                         default='unet', help='denoising model architecture (default: unet)')
 
     parser.add_argument('--optim', choices=['adam', 'adagrad', 'sgd'], default='adagrad',
                         help='optimizer (default: adagrad)')
     parser.add_argument('--lr', default=0.001, type=float, help='learning rate for the optimizer (default: 0.001)')
+    parser.add_argument('--lr-schedule', choices=['constant', 'cosine', 'step', 'plateau'], default='constant',
+                        help='learning rate schedule, stepped once per epoch (per --val-every steps with --steps). cosine anneals to --min-lr over the run, step multiplies the rate by --lr-factor every --lr-step-size periods, plateau does so after --lr-patience periods without improvement of the validation loss, or of the training loss without held out pairs (default: constant)')
+    parser.add_argument('--lr-step-size', type=int, default=30, help='periods between decays of the step schedule (default: 30)')
+    parser.add_argument('--lr-factor', type=float, default=0.1, help='decay factor of the step and plateau schedules (default: 0.1)')
+    parser.add_argument('--lr-patience', type=int, default=10, help='patience in periods of the plateau schedule (default: 10)')
+    parser.add_argument('--min-lr', type=float, default=0, help='lower bound of the cosine and plateau schedules (default: 0)')
+    parser.add_argument('--early-stop', type=int, default=0,
+                        help='stop training once the validation loss (the training loss without held out pairs) has not improved for this many epochs (validation periods with --steps). 0 disables early stopping (default: 0)')
+    parser.add_argument('--min-delta', type=float, default=0,
+                        help='minimum decrease of the validation loss that counts as an improvement (default: 0)')
     parser.add_argument('--criteria', default='L2', choices=['L0', 'L1', 'L2'], help='training criteria (default: L2)')
 
     parser.add_argument('-c', '--crop', type=int, default=800, help='training crop size (default: 800)')
+    parser.add_argument('--crop-start', type=int,
+                        help='start training on crops of this size and double it in stages until --crop is reached, scaling the batch size with the crop area to keep memory use roughly constant. validation always uses --crop (default: none)')
+    parser.add_argument('--crop-warmup', type=int,
+                        help='number of epochs (validation periods with --steps) over which the crop grows to --crop (default: half of the run)')
     parser.add_argument('--batch-size', type=int, default=4, help='training batch size (default: 4)')
 
     parser.add_argument('--num-epochs', default=100, type=int, help='number of training epochs (default: 100)')
+    parser.add_argument('--steps', type=int,
+                        help='train for this many iterations instead of --num-epochs, crops are drawn indefinitely so the cost of a run does not depend on the number of micrographs (default: none)')
+    parser.add_argument('--val-every', type=int, default=1000,
+                        help='with --steps, validate every this many iterations (default: 1000)')
+    parser.add_argument('--save-every', type=int,
+                        help='with --steps, save a checkpoint every this many iterations (default: --val-every)')
+    parser.add_argument('--amp', action='store_true',
+                        help='train with automatic mixed precision, float16 with loss scaling on GPU and bfloat16 on CPU')
 
     parser.add_argument('--num-workers', default=16, type=int,
                         help='number of threads to use for loading data during training (default: 16)')
     parser.add_argument('-j', '--num-threads', type=int, default=0,
                         help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
 
-    return parser
-
+    # distributed data-parallel training
+    parser.add_argument('--ddp', type=int, default=0,
+                        help='train with torch.distributed using this many processes per node, 0 uses a single process with DataParallel (default: 0)')
+    parser.add_argument('--dist-backend', choices=['gloo', 'nccl'], default='gloo',
+                        help='torch.distributed backend, gloo also works on CPU-only nodes (default: gloo)')
+    parser.add_argument('--nnodes', type=int, default=1, help='number of nodes taking part in distributed training (default: 1)')
+    parser.add_argument('--node-rank', type=int, default=0, help='rank of this node for distributed training (default: 0)')
+    parser.add_argument('--master-addr', default='127.0.0.1',
+                        help='address of the rank 0 node for distributed training (default: 127.0.0.1)')
+    parser.add_argument('--master-port', type=int, default=29500,
+                        help='port of the rank 0 node for distributed training (default: 29500)')
 
-# import topaz.denoise as dn
-# from topaz.utils.image import save_image
+    return parser
 
-import denoise as dn
-from utils.image import save_image
 
 
 # 20221017 Modified by Zhidong Yang
-def make_paired_images_datasets(dir_a, dir_b, dir_grad, crop, random=np.random, holdout=0.1, preload=False, cutoff=0):
+def make_paired_images_datasets(dir_a, dir_b, dir_grad, crop, random=None, holdout=0.1, preload=False, cutoff=0):
+    import numpy as np
+    import denoise as dn
+    if random is None:
+        random = np.random
+
     # train denoising model
     # make the dataset
     A = []
@@ -154,14 +231,20 @@ def make_paired_images_datasets(dir_a, dir_b, dir_grad, crop, random=np.random,
     print('# validating on', len(A_val), 'image pairs', file=sys.stderr)
 
     dataset_train = dn.PairedImages(A_train, B_train, G_train, crop=crop, xform=True, preload=preload, cutoff=cutoff)
-    dataset_val = dn.PairedImages(A_val, B_val, G_train, crop=crop, preload=preload, cutoff=cutoff)
+    dataset_val = dn.PairedImages(A_val, B_val, G_val, crop=crop, preload=preload, cutoff=cutoff)
 
     return dataset_train, dataset_val
 
 
-def make_images_datasets(dir_a, dir_b, dir_grad, crop, random=np.random, holdout=0.1, cutoff=0):
+def make_images_datasets(dir_a, dir_b, crop, random=None, holdout=0.1, preload=False, cutoff=0):
+    import numpy as np
+    import denoise as dn
+    if random is None:
+        random = np.random
+
     # train denoising model
     # make the dataset
+    # filtered guidance images are not noisy observations, so only A and B are used
     paths = []
     for path in glob.glob(dir_a + os.sep + '*.mrc'):
         paths.append(path)
@@ -170,11 +253,6 @@ def make_images_datasets(dir_a, dir_b, dir_grad, crop, random=np.random, holdout
         for path in glob.glob(dir_b + os.sep + '*.mrc'):
             paths.append(path)
 
-    # 20221017 Modified by Zhidong Yang
-    if dir_grad is not None:
-        for path in glob.glob(dir_grad + os.sep + '*.mrc'):
-            paths.append(path)
-
     # randomly hold out some image pairs for validation
     n = int(holdout * len(paths))
     order = random.permutation(len(paths))
@@ -186,31 +264,112 @@ def make_images_datasets(dir_a, dir_b, dir_grad, crop, random=np.random, holdout
     for i in range(n, len(paths)):
         path_train.append(paths[order[i]])
 
-    print('# training with', len(path_train), 'image pairs', file=sys.stderr)
-    print('# validating on', len(path_val), 'image pairs', file=sys.stderr)
+    print('# training with', len(path_train), 'images', file=sys.stderr)
+    print('# validating on', len(path_val), 'images', file=sys.stderr)
 
-    dataset_train = dn.NoiseImages(path_train, crop=crop, xform=True, cutoff=cutoff)
-    dataset_val = dn.NoiseImages(path_val, crop=crop, cutoff=cutoff)
+    dataset_train = dn.NoiseImages(path_train, crop=crop, xform=True, preload=preload, cutoff=cutoff)
+    dataset_val = dn.NoiseImages(path_val, crop=crop, preload=preload, cutoff=cutoff)
 
     return dataset_train, dataset_val
 
 
-def denoise_image(mic, models, lowpass=1, cutoff=0, gaus=None, inv_gaus=None, deconvolve=False
-                  , deconv_patch=1, patch_size=-1, padding=0, normalize=False
-                  , use_cuda=False):
+def make_distill_datasets(dir_a, dir_b, teacher, cache_dir, since=0, crop=800, random=None, holdout=0.1
+                          , preload=False, cutoff=0, use_cuda=False, patch_size=-1, padding=128):
+    import numpy as np
+    import denoise as dn
+    import parallel
+    if random is None:
+        random = np.random
+
+    # noisy micrographs paired with the outputs of a trained teacher model
+    paths = []
+    for path in glob.glob(dir_a + os.sep + '*.mrc'):
+        paths.append(path)
+
+    if dir_b is not None:
+        for path in glob.glob(dir_b + os.sep + '*.mrc'):
+            paths.append(path)
+
+    # rank 0 computes the teacher outputs, the other processes then find them in the cache
+    if not parallel.is_main_process():
+        parallel.barrier()
+    targets = dn.cache_teacher_outputs(teacher, paths, cache_dir, since=since, cutoff=cutoff, use_cuda=use_cuda
+                                       , patch_size=patch_size, padding=padding)
+    if parallel.is_main_process():
+        parallel.barrier()
+
+    # randomly hold out some images for validation
+    n = int(holdout * len(paths))
+    order = random.permutation(len(paths))
+
+    path_train = [paths[i] for i in order[n:]]
+    path_val = [paths[i] for i in order[:n]]
+    target_train = [targets[i] for i in order[n:]]
+    target_val = [targets[i] for i in order[:n]]
+
+    print('# training with', len(path_train), 'images', file=sys.stderr)
+    print('# validating on', len(path_val), 'images', file=sys.stderr)
+
+    dataset_train = dn.DistillImages(path_train, target_train, crop=crop, xform=True, preload=preload, cutoff=cutoff)
+    dataset_val = dn.DistillImages(path_val, target_val, crop=crop, preload=preload, cutoff=cutoff)
+
+    return dataset_train, dataset_val
+
+
+def make_hdf5_datasets(path, paired=True, crop=800, random=None, holdout=0.1, preload=False, cutoff=0):
+    # train denoising model from a chunked HDF5 training store, see make_hdf_cmd.py
+    import numpy as np
+    from utils.data.hdf import read_store_names, HDFImages, HDFPairedImages
+    if random is None:
+        random = np.random
+
+    names = read_store_names(path)
+
+    # randomly hold out some image pairs for validation
+    n = int(holdout * len(names))
+    order = random.permutation(len(names))
+
+    names_val = [names[order[i]] for i in range(n)]
+    names_train = [names[order[i]] for i in range(n, len(names))]
+
+    print('# training with', len(names_train), 'image pairs', file=sys.stderr)
+    print('# validating on', len(names_val), 'image pairs', file=sys.stderr)
+
+    if paired:
+        dataset_train = HDFPairedImages(path, names_train, crop=crop, xform=True, preload=preload, cutoff=cutoff)
+        dataset_val = HDFPairedImages(path, names_val, crop=crop, xform=False, preload=preload, cutoff=cutoff)
+    else:
+        # without pairs every stored image is an independent sample
+        items_train = [name + '/' + key for name in names_train for key in ('x', 'y')]
+        items_val = [name + '/' + key for name in names_val for key in ('x', 'y')]
+        dataset_train = HDFImages(path, items_train, crop=crop, xform=True, preload=preload, cutoff=cutoff)
+        dataset_val = HDFImages(path, items_val, crop=crop, xform=False, preload=preload, cutoff=cutoff)
+
+    return dataset_train, dataset_val
+
+
+def preprocess_image(mic, lowpass=1, cutoff=0, gaus=None, inv_gaus=None, deconvolve=False, deconv_patch=1
+                     , use_cuda=False):
+    # normalized micrograph tensor and the mean and std. dev. to restore the pixel scaling with.
+    # a writeable float32 mic is normalized in place
+    import numpy as np
+    import torch
+    import denoise as dn
+    from utils.image import standardize
+
     if lowpass > 1:
         mic = dn.lowpass(mic, lowpass)
 
-    mic = torch.from_numpy(mic)
+    # normalize and remove outliers, in place and in one pass for the statistics
     if use_cuda:
-        mic = mic.cuda()
-
-    # normalize and remove outliers
-    mu = mic.mean()
-    std = mic.std()
-    x = (mic - mu) / std
-    if cutoff > 0:
-        x[(x < -cutoff) | (x > cutoff)] = 0
+        x = torch.from_numpy(np.ascontiguousarray(mic, dtype=np.float32)).cuda()
+        std, mu = torch.std_mean(x)
+        x.sub_(mu).div_(std)
+        if cutoff > 0:
+            x.masked_fill_(x.abs() > cutoff, 0)
+    else:
+        x, mu, std = standardize(mic, cutoff=cutoff, ddof=1)
+        x = torch.from_numpy(x)
 
     # apply guassian/inverse gaussian filter
     if gaus is not None:
@@ -221,26 +380,245 @@ def denoise_image(mic, models, lowpass=1, cutoff=0, gaus=None, inv_gaus=None, de
         # estimate optimal filter and correct spatial correlation
         x = dn.correct_spatial_covariance(x, patch=deconv_patch)
 
-    # denoise
-    mic = 0
-    for model in models:
-        mic += dn.denoise(model, x, patch_size=patch_size, padding=padding)
-    mic /= len(models)
+    return x, mu, std
+
 
-    # restore pixel scaling
+def restore_image(mic, mu, std, normalize=False):
+    # restore pixel scaling, in place on the denoised tensor
+    import torch
     if normalize:
-        mic = (mic - mic.mean()) / mic.std()
+        std_out, mu_out = torch.std_mean(mic)
+        mic.sub_(mu_out).div_(std_out)
     else:
         # add back std. dev. and mean
-        mic = std * mic + mu
+        mic.mul_(std).add_(mu)
 
     # back to numpy/cpu
-    mic = mic.cpu().numpy()
+    return mic.cpu().numpy()
+
+
+def denoise_image(mic, models, lowpass=1, cutoff=0, gaus=None, inv_gaus=None, deconvolve=False
+                  , deconv_patch=1, patch_size=-1, padding=0, normalize=False
+                  , use_cuda=False):
+    import denoise as dn
 
-    return mic
+    x, mu, std = preprocess_image(mic, lowpass=lowpass, cutoff=cutoff, gaus=gaus, inv_gaus=inv_gaus
+                                  , deconvolve=deconvolve, deconv_patch=deconv_patch, use_cuda=use_cuda)
+
+    # denoise
+    mic = 0
+    for model in models:
+        mic += dn.denoise(model, x, patch_size=patch_size, padding=padding)
+    mic /= len(models)
+
+    return restore_image(mic, mu, std, normalize=normalize)
+
+
+def denoise_images(mics, models, cutoff=0, patch_size=-1, padding=0, normalize=False, batch_size=8
+                   , use_cuda=False):
+    # denoise_image for a list of micrographs, micrographs of the same shape are normalized, denoised
+    # and restored together as one batch
+    import numpy as np
+    import torch
+    import denoise as dn
+
+    denoised = [None] * len(mics)
+    groups = {}
+    for k, mic in enumerate(mics):
+        groups.setdefault(mic.shape, []).append(k)
+
+    for index in groups.values():
+        for b in range(0, len(index), batch_size):
+            chunk = index[b:b + batch_size]
+            x = torch.from_numpy(np.stack([mics[k] for k in chunk]))
+            if use_cuda:
+                x = x.cuda()
+
+            # normalize and remove outliers, per micrograph
+            std, mu = torch.std_mean(x, (1, 2), keepdim=True)
+            x.sub_(mu).div_(std)
+            if cutoff > 0:
+                x.masked_fill_(x.abs() > cutoff, 0)
+
+            y = 0
+            for model in models:
+                y += torch.stack(dn.denoise_batch(model, list(x), patch_size=patch_size, padding=padding
+                                                  , batch_size=batch_size))
+            y /= len(models)
+
+            # restore pixel scaling
+            if normalize:
+                std_out, mu_out = torch.std_mean(y, (1, 2), keepdim=True)
+                y.sub_(mu_out).div_(std_out)
+            else:
+                y.mul_(std).add_(mu)
+
+            y = y.cpu().numpy()
+            for k, yk in zip(chunk, y):
+                denoised[k] = yk
+
+    return denoised
+
+
+def watch_micrographs(directory, models, output=None, suffix='', format_='mrc', mrc_dtype='float32', pattern='*.mrc'
+                      , settle=5, poll_interval=2, timeout=0, log_path=None, previews=None, preview_dir=None, **kwargs):
+    # denoise micrographs as they are completed in directory, kwargs are passed to denoise_image
+    import numpy as np
+    from utils.data.loader import load_image
+    from utils.image import save_image
+    from watch import ProcessedLog, FolderWatcher
+
+    if log_path is None:
+        log_path = os.path.join(output or directory, 'said_processed.jsonl')
+    log = ProcessedLog(log_path)
+    watcher = FolderWatcher(directory, log, pattern=pattern, settle=settle)
+    print('# watching {}, {} micrographs already processed'.format(directory, len(log)), file=sys.stderr)
+
+    last = time.time()
+    try:
+        while timeout <= 0 or time.time() - last < timeout:
+            for path, stat in watcher.ready():
+                tic = time.time()
+                try:
+                    mic = np.array(load_image(path), copy=False).astype(np.float32)
+                except Exception as e:
+                    print('# skipping {}: {}'.format(path, e), file=sys.stderr)
+                    watcher.skip(path, stat)
+                    continue
+                mic = denoise_image(mic, models, **kwargs)
+                outpath = output_path(path, output, suffix=suffix, format_=format_)
+                save_image(mic, outpath, dtype=mrc_dtype)
+                if previews is not None:
+                    previews.submit(mic, output_path(path, preview_dir, suffix=suffix, format_=previews.format_))
+                log.add(path, stat, os.path.abspath(outpath))
+                last = time.time()
+                print('# {} denoised in {:.2f}s, {} in total'.format(os.path.basename(path), last - tic, len(log))
+                      , file=sys.stderr)
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    print('# stopped watching {}, {} micrographs processed'.format(directory, len(log)), file=sys.stderr)
+
+
+def pending_micrographs(args, model_checksums):
+    # manifest of earlier outputs and the (path, output path, key) of the micrographs that are not up to date
+    from manifest import ResultManifest, RESULT_OPTIONS, result_key
+
+    manifest = ResultManifest(args.manifest or os.path.join(args.output, 'said_manifest.jsonl'))
+    settings = {'models': model_checksums, 'suffix': args.suffix}
+    settings.update({option: getattr(args, option) for option in RESULT_OPTIONS})
+    # previews are not recorded, a micrograph whose preview is missing is denoised again
+    preview_dir = preview_directory(args) if args.preview is not None else None
+
+    pending = []
+    for path in args.micrographs:
+        outpath = output_path(path, args.output, suffix=args.suffix, format_=args.format_)
+        key = result_key(path, settings, content=(args.skip_hash == 'content'))
+        current = manifest.is_current(outpath, key)
+        if current and preview_dir is not None:
+            current = os.path.exists(output_path(path, preview_dir, suffix=args.suffix, format_=args.preview))
+        if not current:
+            pending.append((path, outpath, key))
+    return manifest, pending
+
+
+def mark_shard_done(args, outputs=None, sections=None):
+    # completion marker of this shard, next to its outputs
+    import shard
+    if outputs is None:
+        outputs = [os.path.abspath(output_path(path, args.output, suffix=args.suffix, format_=args.format_))
+                   for path in args.micrographs]
+        directory = args.output
+    else:
+        outputs = [os.path.abspath(path) for path in outputs]
+        directory = os.path.dirname(os.path.abspath(args.output))
+    inputs = [os.path.abspath(path) for path in args.micrographs]
+    marker = shard.write_marker(directory, args.shard_index, args.num_shards, inputs, outputs, sections=sections)
+    print('# wrote', marker, file=sys.stderr)
+
+
+def preview_directory(args):
+    return args.preview_dir or os.path.join(args.output or args.watch or '.', 'preview')
+
+
+def output_path(path, output=None, suffix='', format_='mrc'):
+    # path of the denoised micrograph, next to the input with a default suffix if there is no output directory
+    import mrc
+    if not output:
+        if suffix == '' or suffix is None:
+            suffix = '.denoised'
+        no_ext, ext = mrc.splitext(path)
+        return no_ext + suffix + '.' + format_
+    name, _ = mrc.splitext(os.path.basename(path))
+    return output + os.sep + name + suffix + '.' + format_
+
+
+def load_trained_model(path, use_cuda=False, retraining=None):
+    import denoise as dn
+    import parallel
+    import registry
+    from checkpoint import model_state
+    from prune import resize_to_state_dict
+
+    # the model class is read from the checkpoint header or detected from its parameters,
+    # unless it is forced with the -ret choice used for training
+    # registered names are resolved and checked against their checksum, weights are memory mapped and
+    # cached, so loading the same model again in this process is free
+    model_load = registry.load_checkpoint(path)
+    state = model_state(model_load)
+
+    if retraining is None:
+        model = dn.model_from_checkpoint(model_load)
+        print('# {} is a {}'.format(path, type(model).__name__), file=sys.stderr)
+    elif path == './pretrained/unet_L2_v0.2.1.sav':
+        model = dn.UDenoiseNetPre(base_width=7)
+    else:
+        model = dn.UDenoiseNet()
+
+    if retraining == 'finetune':
+        model = dn.UDenoiseNetPre(base_width=7)
+        # model = dn.UDenoiseNet()
+    elif retraining == 'abinit':
+        model = dn.UDenoiseNet()
+    elif retraining == 'abinitMaxpool':
+        model = dn.UDenoiseNetMaxpool()
+    elif retraining == 'abinitBFNet':
+        # model = dn.UDenoiseNetBiasFree()
+        model = dn.UDenoiseNetNonPoolBiasFree()
+    elif retraining == 'abinitBFNonMaxpool':
+        model = dn.UDenoiseNetNonPoolBiasFree(base_width=7)
+
+    # if use_cuda:
+    #     model.cuda(device=0)
+    #     # model.cuda()
+    model = parallel.parallelize(model, use_cuda=use_cuda, distributed=False)
+    # model.eval()
+    # pruned models have narrower layers than the default construction
+    # parameters saved from an unwrapped model, like the topaz weights, have no "module." prefix
+    target = model if any(k.startswith('module.') for k in state) else model.module
+    resize_to_state_dict(target, state)
+    target.load_state_dict(state)
+    model.eval()
+    return model
 
 
 def main(args):
+    import numpy as np
+    import torch
+
+    import cuda
+    import mrc
+    import parallel
+    import denoise as dn
+    import registry
+    from checkpoint import Checkpointer, load_checkpoint, model_state
+    from utils.data.loader import load_image
+    from utils.image import save_image
+
+    # under torch.distributed every process draws its own crops, flips and masks.
+    # the parameters still start equal, DistributedDataParallel broadcasts them from rank 0
+    seed_everything(1234 + parallel.get_rank())
+
     # set the number of threads
     num_threads = args.num_threads
     # from topaz.torch import set_num_threads
@@ -255,26 +633,55 @@ def main(args):
 
     cutoff = args.pixel_cutoff  # pixel truncation limit
 
+    sharded = args.num_shards > 1 or args.shard_plan is not None
+    if sharded and not args.stack:
+        import shard
+        if args.watch is not None:
+            raise Exception('--watch cannot be combined with sharding')
+        if args.shard_plan is not None:
+            args.micrographs, args.num_shards = shard.read_plan(args.shard_plan, args.shard_index)
+        else:
+            args.micrographs = shard.partition(args.micrographs, args.num_shards)[args.shard_index]
+        print('# shard {} of {}: {} micrographs'.format(args.shard_index, args.num_shards, len(args.micrographs))
+              , file=sys.stderr)
+    manifest = None  # outputs of earlier runs, with --skip-done
+
     # 20221017 Modified by Zhidong Yang
     do_train = (args.dir_a is not None and args.dir_b is not None and args.dir_grad is not None) or (
                 args.hdf is not None)
+    # the masked method does not need pairs or guidance images
+    do_train = do_train or (args.method in ('masked', 'distill') and args.dir_a is not None)
 
     if do_train:
 
         method = args.method
         paired = (method == 'noise2noise')
+        has_targets = paired or (method == 'distill')  # datasets with a second image list y
+
+        teacher = None
+        if method == 'distill':
+            if args.teacher is None:
+                raise Exception('--method distill requires a --teacher model')
+            if args.hdf is not None:
+                raise Exception('--method distill reads micrographs from -a/-b, not from --hdf')
+            print('# Loading teacher model:', args.teacher, file=sys.stderr)
+            teacher = load_trained_model(args.teacher, use_cuda=use_cuda, retraining=args.retraining)
+            teacher_path, _ = registry.resolve(args.teacher)
+            teacher_cache = args.teacher_cache
+            if teacher_cache is None:
+                teacher_cache = os.path.splitext(teacher_path)[0] + '_outputs'
         preload = args.preload
         holdout = args.holdout  # fraction of image pairs to holdout for validation
-        retraining = args.retraining
+        retraining = args.retraining or 'abinit'
 
         # 20221017 Modified by Zhidong Yang
         if args.hdf is None:  # use dirA/dirB
             crop = args.crop
             dir_as = args.dir_a
-            dir_bs = args.dir_b
+            dir_bs = args.dir_b or [None] * len(dir_as)
 
             # 20221017 Modified by Zhidong Yang
-            dir_grads = args.dir_grad
+            dir_grads = args.dir_grad or [None] * len(dir_as)
 
             dset_train = []
             dset_val = []
@@ -282,7 +689,19 @@ def main(args):
             # 20221017 Modified by Zhidong Yang
             for dir_a, dir_b, dir_grad in zip(dir_as, dir_bs, dir_grads):
                 random = np.random.RandomState(44444)
-                if paired:
+                if method == 'distill':
+                    dataset_train, dataset_val = make_distill_datasets(dir_a, dir_b, teacher, teacher_cache
+                                                                       , since=os.path.getmtime(teacher_path)
+                                                                       , crop=crop
+                                                                       , random=random
+                                                                       , holdout=holdout
+                                                                       , preload=preload
+                                                                       , cutoff=cutoff
+                                                                       , use_cuda=use_cuda
+                                                                       , patch_size=args.patch_size
+                                                                       , padding=args.patch_padding
+                                                                       )
+                elif paired:
                     dataset_train, dataset_val = make_paired_images_datasets(dir_a, dir_b, dir_grad, crop
                                                                              , random=random
                                                                              , holdout=holdout
@@ -290,32 +709,51 @@ def main(args):
                                                                              , cutoff=cutoff
                                                                              )
                 else:
-                    dataset_train, dataset_val = make_images_datasets(dir_a, dir_b, dir_grad, crop
+                    dataset_train, dataset_val = make_images_datasets(dir_a, dir_b, crop
                                                                       , cutoff=cutoff
                                                                       , random=random
-                                                                      , holdout=holdout)
+                                                                      , holdout=holdout
+                                                                      , preload=preload)
                 dset_train.append(dataset_train)
                 dset_val.append(dataset_val)
 
             dataset_train = dset_train[0]
             for i in range(1, len(dset_train)):
                 dataset_train.x += dset_train[i].x
-                if paired:
+                if has_targets:
                     dataset_train.y += dset_train[i].y
+                if paired:
+                    dataset_train.g += dset_train[i].g
 
             dataset_val = dset_val[0]
             for i in range(1, len(dset_val)):
                 dataset_val.x += dset_val[i].x
-                if paired:
+                if has_targets:
                     dataset_val.y += dset_val[i].y
+                if paired:
+                    dataset_val.g += dset_val[i].g
 
             shuffle = True
         else:  # make HDF datasets
+            random = np.random.RandomState(44444)
             dataset_train, dataset_val = make_hdf5_datasets(args.hdf, paired=paired
+                                                            , crop=args.crop
+                                                            , random=random
                                                             , cutoff=cutoff
                                                             , holdout=holdout
                                                             , preload=preload)
-            shuffle = preload
+            # chunked storage makes random access cheap, so shuffling does not need preloading
+            shuffle = True
+            if paired and args.weight_guidance > 0 and not dataset_train.has_guidance:
+                print('# Warning: training store has no guidance images, the guidance loss is skipped'
+                      , file=sys.stderr)
+
+        if len(dataset_val) == 0:
+            # nothing is held out, the schedule and early stopping follow the training loss
+            dataset_val = None
+            if parallel.is_main_process():
+                print('# Warning: no validation set, the learning rate schedule and early stopping follow the'
+                      ' training loss and no model_best.sav is written', file=sys.stderr)
 
         # initialize the model
         arch = args.arch
@@ -349,41 +787,59 @@ def main(args):
             # pre_trained_model = './pretrained/unet_L2_v0.2.1.sav'
             pre_trained_model = './models/model_epoch180.sav'
             print('Loading Pre-trained model: ' + pre_trained_model)
-            model = nn.DataParallel(model, device_ids=[0,1])
-            model.to(device_m)
-            # if use_cuda:
-            #     model = model.cuda(device=0)
+            model = parallel.parallelize(model, use_cuda=use_cuda)
             model_load = torch.load(pre_trained_model)
-            model.load_state_dict(model_load)
+            model.load_state_dict(model_state(model_load))
             print('Pre-trained parameters are loaded')
         else:
-            model = nn.DataParallel(model, device_ids=[0,1])
-            model.to(device_m)
-            # if use_cuda:
-            #     # model = model.cuda()
-            #     model = model.cuda(device=0)
+            model = parallel.parallelize(model, use_cuda=use_cuda)
+
+        resume = None
+        if args.resume is not None:
+            resume = load_checkpoint(args.resume)
+            model.load_state_dict(resume['model'])
+            unit = 'epoch' if args.steps is None else 'step'
+            print('# resuming from {} {} of {}'.format(unit, resume.get(unit), args.resume), file=sys.stderr)
 
         # train
         optim = args.optim
         lr = args.lr
         batch_size = args.batch_size
         num_epochs = args.num_epochs
-        digits = int(np.ceil(np.log10(num_epochs)))
+        steps = args.steps
+        unit = 'epoch' if steps is None else 'step'
+        digits = int(np.ceil(np.log10(num_epochs if steps is None else steps)))
 
         num_workers = args.num_workers
         criteria = args.criteria
 
         # 20221018 Modified by Zhidong Yang
-        print('Selected criteria is ' + str(criteria))
         weight_guidance = args.weight_guidance
         weight_gradient = args.weight_gradient
-        print('Weight of filterer guidance loss is ' + str(weight_guidance))
-        print('Weight of gradient sparsity loss is ' + str(weight_gradient))
-        print('The initialization of parameters ' + retraining)
-
-        print('epoch', 'loss_train', 'loss_val')
+        if parallel.is_main_process():
+            print('Selected criteria is ' + str(criteria))
+            print('Weight of filterer guidance loss is ' + str(weight_guidance))
+            print('Weight of gradient sparsity loss is ' + str(weight_gradient))
+            print('The initialization of parameters ' + retraining)
+
+            if dataset_val is not None:
+                print(unit, 'loss_train', 'loss_val')
+            else:
+                print(unit, 'loss_train')
         # criteria = nn.L1Loss()
 
+        curriculum = None
+        if args.crop_start is not None:
+            num_periods = num_epochs if steps is None else -(-steps // args.val_every)
+            warmup = args.crop_warmup if args.crop_warmup is not None else num_periods // 2
+            curriculum = dn.CropCurriculum(args.crop, batch_size, start=args.crop_start, warmup=warmup)
+
+        # checkpoints are written by rank 0 from a background thread
+        checkpointer = None
+        if args.save_prefix is not None and parallel.is_main_process():
+            checkpointer = Checkpointer(args.save_prefix, digits=digits, keep=args.keep_checkpoints, unit=unit
+                                        , header=dn.architecture_header(model))
+
         if method == 'noise2noise':
             iterator = dn.train_noise2noise(model, dataset_train, lr=lr
                                             , optim=optim
@@ -396,12 +852,26 @@ def main(args):
                                             , use_cuda=use_cuda
                                             , num_workers=num_workers
                                             , shuffle=shuffle
+                                            , amp=args.amp
+                                            , checkpointer=checkpointer
+                                            , resume=resume
+                                            , steps=steps
+                                            , val_every=args.val_every
+                                            , save_every=args.save_every
+                                            , lr_schedule=args.lr_schedule
+                                            , lr_step_size=args.lr_step_size
+                                            , lr_factor=args.lr_factor
+                                            , lr_patience=args.lr_patience
+                                            , min_lr=args.min_lr
+                                            , early_stop=args.early_stop
+                                            , min_delta=args.min_delta
+                                            , curriculum=curriculum
                                             )
         elif method == 'masked':
             iterator = dn.train_mask_denoise(model, dataset_train, lr=lr
+                                             , p=args.mask_rate
+                                             , stratified=(args.mask_sampling == 'grid')
                                              , optim=optim
-                                             , weight_guidance=weight_guidance
-                                             , weight_gradient=weight_gradient
                                              , batch_size=batch_size
                                              , criteria=criteria
                                              , num_epochs=num_epochs
@@ -409,63 +879,83 @@ def main(args):
                                              , use_cuda=use_cuda
                                              , num_workers=num_workers
                                              , shuffle=shuffle
+                                             , amp=args.amp
+                                             , checkpointer=checkpointer
+                                             , resume=resume
+                                             , steps=steps
+                                             , val_every=args.val_every
+                                             , save_every=args.save_every
+                                             , lr_schedule=args.lr_schedule
+                                             , lr_step_size=args.lr_step_size
+                                             , lr_factor=args.lr_factor
+                                             , lr_patience=args.lr_patience
+                                             , min_lr=args.min_lr
+                                             , early_stop=args.early_stop
+                                             , min_delta=args.min_delta
+                                             , curriculum=curriculum
                                              )
 
-        for epoch, loss_train, loss_val in iterator:
-            print(epoch, loss_train, loss_val)
+        elif method == 'distill':
+            iterator = dn.train_distill(model, dataset_train, lr=lr
+                                        , optim=optim
+                                        , batch_size=batch_size
+                                        , criteria=criteria
+                                        , num_epochs=num_epochs
+                                        , dataset_val=dataset_val
+                                        , use_cuda=use_cuda
+                                        , num_workers=num_workers
+                                        , shuffle=shuffle
+                                        , amp=args.amp
+                                        , checkpointer=checkpointer
+                                        , resume=resume
+                                        , steps=steps
+                                        , val_every=args.val_every
+                                        , save_every=args.save_every
+                                        , lr_schedule=args.lr_schedule
+                                        , lr_step_size=args.lr_step_size
+                                        , lr_factor=args.lr_factor
+                                        , lr_patience=args.lr_patience
+                                        , min_lr=args.min_lr
+                                        , early_stop=args.early_stop
+                                        , min_delta=args.min_delta
+                                        , curriculum=curriculum
+                                        )
+
+        main_process = parallel.is_main_process()
+        for losses in iterator:
+            if not main_process:
+                continue
+            # (index, loss_train, loss_val), without loss_val when nothing is held out
+            print(*losses)
             sys.stdout.flush()
 
-            # save the model
-            if args.save_prefix is not None:
-                path = args.save_prefix + ('model_epoch{:0' + str(digits) + '}.sav').format(epoch)
-                if not os.path.exists(args.save_prefix):
-                    os.makedirs(args.save_prefix)
-                # path = args.save_prefix + '_epoch{}.sav'.format(epoch)
-                model.cpu()
-                model.eval()
-                # torch.save(model, path)
-                torch.save(model.state_dict(), path)
-                if use_cuda:
-                    model.cuda()
-                    # model.cuda(device=0)
+        if checkpointer is not None:
+            checkpointer.close()
 
         models = [model]
 
+        # only the rank 0 process goes on to denoise micrographs
+        if not main_process:
+            return
+
     else:  # load the saved model(s)
+        if args.skip_done and not args.stack and args.watch is None:
+            model_checksums = [registry.sha256(registry.resolve(arg)[0]) for arg in args.model]
+            manifest, pending = pending_micrographs(args, model_checksums)
+            if len(pending) == 0:
+                # nothing changed, the models are not even loaded
+                print('# all {} micrographs are up to date'.format(len(args.micrographs)), file=sys.stderr)
+                if sharded:
+                    mark_shard_done(args)
+                return
+
         models = []
         for arg in args.model:
             if arg == 'none':
                 print('# Warning: no denoising model will be used', file=sys.stderr)
             else:
                 print('# Loading model:', arg, file=sys.stderr)
-            if arg == './pretrained/unet_L2_v0.2.1.sav':
-                model = dn.UDenoiseNetPre(base_width=7)
-            else:
-                model = dn.UDenoiseNet()
-
-            if args.retraining == 'finetune':
-                model = dn.UDenoiseNetPre(base_width=7)
-                # model = dn.UDenoiseNet()
-            elif args.retraining == 'abinit':
-                model = dn.UDenoiseNet()
-            elif args.retraining == 'abinitMaxpool':
-                model = dn.UDenoiseNetMaxpool()
-            elif args.retraining == 'abinitBFNet':
-                # model = dn.UDenoiseNetBiasFree()
-                model = dn.UDenoiseNetNonPoolBiasFree()
-            elif args.retraining == 'abinitBFNonMaxpool':
-                model = dn.UDenoiseNetNonPoolBiasFree(base_width=7)
-
-            # if use_cuda:
-            #     model.cuda(device=0)
-            #     # model.cuda()
-            model = nn.DataParallel(model, device_ids=[0,1]).to(device_m)
-            # model.eval()
-            model_load = torch.load(arg)
-            # model = torch.load(arg)
-            # print(model_load)
-            model.load_state_dict(model_load)
-            model.eval()
+            model = load_trained_model(arg, use_cuda=use_cuda, retraining=args.retraining)
             models.append(model)
 
     # using trained model
@@ -500,37 +990,90 @@ def main(args):
     ps = args.patch_size
     padding = args.patch_padding
 
+    # micrographs are only batched without the per micrograph filters
+    batch_size = args.denoise_batch_size
+    batched = batch_size > 1 and lowpass <= 1 and gaus is None and inv_gaus is None and not deconvolve
+    if not batched:
+        batch_size = 1
+
+    def denoise_chunk(mics):
+        if batched:
+            return denoise_images([mic.astype(np.float32) for mic in mics], models, cutoff=cutoff
+                                  , patch_size=ps, padding=padding, normalize=normalize
+                                  , batch_size=batch_size, use_cuda=use_cuda)
+        return [denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
+                              , inv_gaus=inv_gaus, deconvolve=deconvolve
+                              , deconv_patch=deconv_patch
+                              , patch_size=ps, padding=padding, normalize=normalize
+                              , use_cuda=use_cuda
+                              ) for mic in mics]
+
     count = 0
 
+    # previews are written by a pool of threads while the next micrographs are denoised
+    previews = None
+    preview_dir = preview_directory(args)
+    if args.preview is not None:
+        if args.stack:
+            print('# Warning: --preview is ignored for a stack', file=sys.stderr)
+        else:
+            from preview import PreviewWriter
+            previews = PreviewWriter(size=args.preview_size, format_=args.preview, workers=args.preview_workers)
+
+    if args.watch is not None:
+        if args.output and not os.path.exists(args.output):
+            os.makedirs(args.output)
+        watch_micrographs(args.watch, models, output=args.output, suffix=suffix, format_=format_, mrc_dtype=args.mrc_dtype
+                          , pattern=args.watch_pattern, settle=args.settle, poll_interval=args.poll_interval
+                          , timeout=args.watch_timeout, log_path=args.processed_log
+                          , previews=previews, preview_dir=preview_dir
+                          , lowpass=lowpass, cutoff=cutoff, gaus=gaus, inv_gaus=inv_gaus
+                          , deconvolve=deconvolve, deconv_patch=deconv_patch
+                          , patch_size=ps, padding=padding, normalize=normalize
+                          , use_cuda=use_cuda
+                          )
+        if previews is not None:
+            previews.close()
+        return
+
     # we are denoising a single MRC stack
     if args.stack:
-        with open(args.micrographs[0], 'rb') as f:
-            content = f.read()
-        stack, _, _ = mrc.parse(content)
+        path = args.output
+        if sharded:
+            # only the sections of this shard are read, and written to a part of the output
+            import shard
+            num_sections = max(shard.read_mrc_header(args.micrographs[0]).nz, 1)
+            start, end = shard.section_range(num_sections, args.shard_index, args.num_shards)
+            if start == end:
+                # more shards than sections, this one has nothing to denoise and writes no part
+                print('# shard {} of {}: no sections'.format(args.shard_index, args.num_shards), file=sys.stderr)
+                mark_shard_done(args, outputs=[], sections=[start, end])
+                return
+            stack = shard.read_sections(args.micrographs[0], start, end)
+            path = shard.stack_part_path(args.output, start, end)
+            print('# shard {} of {}: sections {} to {}'.format(args.shard_index, args.num_shards, start, end)
+                  , file=sys.stderr)
+        else:
+            stack, _, _ = mrc.read(args.micrographs[0])
         print('# denoising stack with shape:', stack.shape, file=sys.stderr)
         total = len(stack)
 
-        denoised = np.zeros_like(stack)
-        for i in range(len(stack)):
-            mic = stack[i]
-            # process and denoise the micrograph
-            mic = denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
-                                , inv_gaus=inv_gaus, deconvolve=deconvolve
-                                , deconv_patch=deconv_patch
-                                , patch_size=ps, padding=padding, normalize=normalize
-                                , use_cuda=use_cuda
-                                )
-            denoised[i] = mic
-
-            count += 1
+        denoised = np.zeros(stack.shape, dtype=np.float32)
+        for i in range(0, len(stack), batch_size):
+            # process and denoise the micrographs
+            mics = denoise_chunk(list(stack[i:i + batch_size]))
+            denoised[i:i + len(mics)] = mics
+
+            count += len(mics)
             print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
 
         print('', file=sys.stderr)
         # write the denoised stack
-        path = args.output
         print('# writing', path, file=sys.stderr)
-        with open(path, 'wb') as f:
-            mrc.write(f, denoised)
+        with mrc.open_file(path, 'wb') as f:
+            mrc.write_tiled(f, denoised, dtype=args.mrc_dtype)
+        if sharded:
+            mark_shard_done(args, outputs=[path], sections=[start, end])
 
     else:
         # stream the micrographs and denoise them
@@ -540,32 +1083,66 @@ def main(args):
         if not os.path.exists(args.output):
             os.makedirs(args.output)
 
-        for path in args.micrographs:
-            name, _ = os.path.splitext(os.path.basename(path))
-            mic = np.array(load_image(path), copy=False).astype(np.float32)
-
-            # process and denoise the micrograph
-            mic = denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
-                                , inv_gaus=inv_gaus, deconvolve=deconvolve
-                                , deconv_patch=deconv_patch
-                                , patch_size=ps, padding=padding, normalize=normalize
-                                , use_cuda=use_cuda
-                                )
-
-            # write the micrograph
-            if not args.output:
-                if suffix == '' or suffix is None:
-                    suffix = '.denoised'
-                # write the file to the same location as input
-                no_ext, ext = os.path.splitext(path)
-                outpath = no_ext + suffix + '.' + format_
-            else:
-                outpath = args.output + os.sep + name + suffix + '.' + format_
-            save_image(mic, outpath)  # , mi=None, ma=None)
-
-            count += 1
-            print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
+        if manifest is None:
+            if args.skip_done:
+                print('# Warning: --skip-done is ignored for a newly trained model', file=sys.stderr)
+            pending = [(path, output_path(path, args.output, suffix=suffix, format_=format_), None)
+                       for path in args.micrographs]
+        count = total - len(pending)
+
+        for b in range(0, len(pending), batch_size):
+            chunk = pending[b:b + batch_size]
+            mics = [np.array(load_image(path), copy=False).astype(np.float32) for path, _, _ in chunk]
+
+            # process and denoise the micrographs
+            mics = denoise_chunk(mics)
+
+            for (path, outpath, key), mic in zip(chunk, mics):
+                # write the micrograph
+                save_image(mic, outpath, dtype=args.mrc_dtype)  # , mi=None, ma=None)
+                if previews is not None:
+                    previews.submit(mic, output_path(path, preview_dir, suffix=suffix, format_=args.preview))
+                if manifest is not None:
+                    manifest.add(outpath, key, path)
+
+                count += 1
+                print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
         print('', file=sys.stderr)
+        if previews is not None:
+            previews.close()
+        if total > len(pending):
+            print('# {} of {} micrographs were up to date and skipped'.format(total - len(pending), total), file=sys.stderr)
+        if sharded:
+            mark_shard_done(args)
+
+
+def distributed_worker(local_rank, args):
+    import cuda
+    import parallel
+
+    use_cuda = cuda.set_device(args.device)
+    if args.num_threads == 0 and not use_cuda:
+        # split the cores between the local processes
+        from multiprocessing import cpu_count
+        args.num_threads = max(1, cpu_count() // args.ddp)
+
+    rank, world_size = parallel.init_process_group(local_rank, args.ddp, nnodes=args.nnodes
+                                                   , node_rank=args.node_rank
+                                                   , master_addr=args.master_addr
+                                                   , master_port=args.master_port
+                                                   , backend=args.dist_backend
+                                                   , use_cuda=use_cuda
+                                                   )
+    print('# process {} of {} started'.format(rank, world_size), file=sys.stderr)
+    try:
+        main(args)
+    finally:
+        parallel.cleanup()
+
+
+def launch_distributed(args):
+    import torch.multiprocessing as mp
+    mp.spawn(distributed_worker, args=(args,), nprocs=args.ddp)
 
 
 if __name__ == '__main__':
@@ -575,7 +1152,10 @@ if __name__ == '__main__':
     parser = ArgumentParser(help)
     add_arguments(parser)
     args = parser.parse_args()
-    main(args)
+    if args.ddp > 0:
+        launch_distributed(args)
+    else:
+        main(args)
 
 
 
@@ -2,35 +2,43 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-class Gradient_Net(nn.Module):
-  def __init__(self, batch_size = 1):
-    super(Gradient_Net, self).__init__()
-    kernel_x = [[-1., 0., 1.], [-2., 0., 2.], [-1., 0., 1.]]
-    kernel_x = torch.FloatTensor(kernel_x).unsqueeze(0).to(device)
+# Sobel kernels stacked as a 2 x 1 x 3 x 3 weight, cached per (device, dtype)
+_sobel_cache = {}
 
-    kernel_y = [[-1., -2., -1.], [0., 0., 0.], [1., 2., 1.]]
-    kernel_y = torch.FloatTensor(kernel_y).unsqueeze(0).to(device)
 
-    kernel_x = kernel_x.expand(batch_size, kernel_x.shape[0], kernel_x.shape[1], kernel_x.shape[2])
-    kernel_y = kernel_y.expand(batch_size, kernel_y.shape[0], kernel_y.shape[1], kernel_x.shape[2])
+def sobel_kernels(device, dtype=torch.float32):
+  key = (device, dtype)
+  weight = _sobel_cache.get(key)
+  if weight is None:
+    kernel_x = [[-1., 0., 1.], [-2., 0., 2.], [-1., 0., 1.]]
+    kernel_y = [[-1., -2., -1.], [0., 0., 0.], [1., 2., 1.]]
+    weight = torch.tensor([kernel_x, kernel_y], dtype=dtype, device=device).unsqueeze(1)
+    _sobel_cache[key] = weight
+  return weight
 
-    self.weight_x = nn.Parameter(data=kernel_x, requires_grad=False)
-    self.weight_y = nn.Parameter(data=kernel_y, requires_grad=False)
 
+class Gradient_Net(nn.Module):
+  def __init__(self, batch_size = 1):
+    # batch_size is kept for compatibility, the kernels work for any N x 1 x H x W batch
+    super(Gradient_Net, self).__init__()
 
   def forward(self, x):
-    # x = self.norm_layer(x)
-    grad_x = F.conv2d(x, self.weight_x)
-    grad_y = F.conv2d(x, self.weight_y)
-    gradient = torch.abs(grad_x) + torch.abs(grad_y)
+    # both Sobel directions in a single convolution, N x 2 x (H-2) x (W-2)
+    weight = sobel_kernels(x.device, x.dtype)
+    grad = F.conv2d(x, weight)
+    gradient = torch.abs(grad).sum(1, keepdim=True)
     return gradient
 
 
-def gradient(x, batch_size):
-    gradient_model = Gradient_Net(batch_size=batch_size).to(device)
-    g = gradient_model(x)
-    return g
+_gradient_net = Gradient_Net()
+
+
+def gradient(x, batch_size=None):
+    return _gradient_net(x)
+
 
+def gradient_sparsity(x):
+    # mean absolute Sobel response, penalizes non-sparse edges in the denoised image
+    return gradient(x).mean()
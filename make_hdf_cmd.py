@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import glob
+
+name = 'make_hdf'
+help = 'pack paired training micrographs into a chunked, compressed HDF5 training store for --hdf'
+
+
+def add_arguments(parser):
+    parser.add_argument('-a', '--dir-a', nargs='+', required=True, help='directory of training images part A')
+    parser.add_argument('-b', '--dir-b', nargs='+', required=True, help='directory of training images part B')
+    parser.add_argument('-grad', '--dir-grad', nargs='+', help='directory of training images with gradient guidance (optional)')
+    parser.add_argument('--guidance-sigma', type=float, default=0,
+                        help='without --dir-grad, store the average of each normalized pair Gaussian filtered with this standard deviation (in pixels) as the guidance image. not used if <=0 (default: 0)')
+
+    parser.add_argument('-o', '--output', required=True, help='path of the HDF5 training store to write')
+    parser.add_argument('--tile', type=int, default=256,
+                        help='chunk size in pixels, random crops only read the chunks they overlap (default: 256)')
+    parser.add_argument('--compression', choices=['gzip', 'lzf', 'none'], default='gzip',
+                        help='chunk compression filter (default: gzip)')
+    parser.add_argument('--compression-level', type=int, default=4, help='gzip compression level (default: 4)')
+
+    return parser
+
+
+def main(args):
+    from utils.data.hdf import write_paired_store
+
+    # zip would silently drop the directories without a counterpart
+    if len(args.dir_b) != len(args.dir_a):
+        raise Exception('-a and -b need the same number of directories, got {} and {}'.format(len(args.dir_a), len(args.dir_b)))
+    dir_grads = args.dir_grad
+    if dir_grads is None:
+        dir_grads = [None] * len(args.dir_a)
+    elif len(dir_grads) != len(args.dir_a):
+        raise Exception('-grad needs one directory per -a directory, got {} and {}'.format(len(dir_grads), len(args.dir_a)))
+
+    A = []
+    B = []
+    G = []
+    for dir_a, dir_b, dir_grad in zip(args.dir_a, args.dir_b, dir_grads):
+        for path in sorted(glob.glob(dir_a + os.sep + '*.mrc')):
+            name = os.path.basename(path)
+            A.append(path)
+            B.append(dir_b + os.sep + name)
+            if dir_grad is not None:
+                G.append(dir_grad + os.sep + name)
+            else:
+                G.append(None)
+
+    compression = args.compression
+    compression_opts = None
+    if compression == 'none':
+        compression = None
+    elif compression == 'gzip':
+        compression_opts = args.compression_level
+
+    print('# packing', len(A), 'image pairs into', args.output, file=sys.stderr)
+    write_paired_store(args.output, A, B, g_paths=G, tile=args.tile, compression=compression
+                       , compression_opts=compression_opts, guidance_sigma=args.guidance_sigma)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
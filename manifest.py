@@ -0,0 +1,65 @@
+from __future__ import print_function, division
+
+import os
+import json
+import time
+import hashlib
+
+"""
+Manifest of denoised outputs, so reruns skip the micrographs whose output is still current.
+
+Every written output is appended to a JSON lines file with a key hashed from the input (its size and
+modification time, or its content), the checksums of the model files and the options that change the
+denoised pixels. An output is current if it exists with the recorded size and the key is unchanged.
+"""
+
+# denoise_cmd options that change the output pixels, retraining forces the model class
+RESULT_OPTIONS = ['lowpass', 'pixel_cutoff', 'gaussian', 'inv_gaussian', 'deconvolve', 'deconv_patch'
+                  , 'patch_size', 'patch_padding', 'normalize', 'format_', 'mrc_dtype', 'retraining']
+
+
+def input_signature(path, content=False):
+    if content:
+        import registry
+        return {'sha256': registry.sha256(path)}
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def result_key(path, settings, content=False):
+    key = {'input': input_signature(path, content=content), 'settings': settings}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class ResultManifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short if the process was killed while writing it
+                        continue
+                    self.entries[entry['output']] = entry
+
+    def is_current(self, output, key):
+        entry = self.entries.get(os.path.abspath(output))
+        if entry is None or entry['key'] != key:
+            return False
+        try:
+            return os.path.getsize(output) == entry['size']
+        except OSError:
+            return False
+
+    def add(self, output, key, path):
+        output = os.path.abspath(output)
+        entry = {'output': output, 'input': os.path.abspath(path), 'key': key
+                 , 'size': os.path.getsize(output), 'time': time.time()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[output] = entry
@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import os
+import sys
 import numpy as np
 import struct
 from collections import namedtuple
@@ -128,6 +130,8 @@ def parse(content):
         dtype = np.complex64
     elif header.mode == 6:
         dtype = np.uint16
+    elif header.mode == 12:
+        dtype = np.float16
     elif header.mode == 16:
         dtype = '3B' # RGB values
     else:
@@ -143,6 +147,9 @@ def parse(content):
 
     return array, header, extended_header
 
+# bytes per voxel of the MRC modes
+MODE_BYTES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2, 16: 3}
+
 def get_mode(dtype):
     if dtype == np.int8:
         return 0
@@ -156,6 +163,8 @@ def get_mode(dtype):
         return 4
     elif dtype == np.uint16:
         return 6
+    elif dtype == np.float16:
+        return 12
     elif dtype == np.dtype('3B'):
         return 16
     
@@ -224,4 +233,97 @@ def write(f, array, header=None, extended_header=b'', ax=1, ay=1, az=1, alpha=0,
     f.write(array.tobytes())
 
 
-
+## compressed MRC files, gzip level 1 and lzma preset 0 compress float data nearly as well as the
+## higher levels at a fraction of the time
+COMPRESSED_EXTS = ['.mrc.gz', '.mrc.xz']
+
+def splitext(path):
+    """ os.path.splitext that keeps the compression suffix of compressed MRC files with the extension """
+    for ext in COMPRESSED_EXTS:
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+def is_mrc(path):
+    return splitext(path)[1] in ['.mrc'] + COMPRESSED_EXTS
+
+def open_file(path, mode='rb'):
+    """ Open an MRC file, compressed with gzip or lzma if its name ends with .gz or .xz """
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, mode, compresslevel=1)
+    elif path.endswith('.xz'):
+        import lzma
+        if 'w' in mode:
+            return lzma.open(path, mode, preset=0)
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+def read(path):
+    with open_file(path) as f:
+        content = f.read()
+    return parse(content)
+
+# bytes per tile written by write_tiled
+TILE_BYTES = 1 << 22
+
+def write_tiled(f, array, dtype=np.float32, ax=1, ay=1, az=1, alpha=0, beta=0, gamma=0, tile_bytes=TILE_BYTES):
+    """
+    Write a 2d image or 3d stack as dtype (float32 or float16, mode 2 or 12) without converting the whole
+    array at once. The header statistics are gathered over the tiles first, then each tile is converted and
+    written, so f can be a compressed stream that cannot seek back to the header. Values beyond the float16
+    range are clipped with a warning. The statistics are those of the written (rounded) values.
+    """
+    dtype = np.dtype(dtype)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    nz, ny, nx = array.shape
+    if nz*ny*nx == 0:
+        raise ValueError('cannot write an empty array of shape {}'.format(array.shape))
+    rows = max(tile_bytes//max(nx*dtype.itemsize, 1), 1)
+
+    def tiles():
+        for z in range(nz):
+            for i in range(0, ny, rows):
+                yield array[z, i:i+rows]
+
+    # float16 overflows to inf, values beyond its range are clipped instead
+    limit = float(np.finfo(np.float16).max) if dtype == np.float16 else None
+
+    def convert(tile):
+        if limit is not None and (tile.min() < -limit or tile.max() > limit):
+            tile = np.clip(tile, -limit, limit)
+        return np.ascontiguousarray(tile, dtype=dtype)
+
+    ## statistics of the values as written, accumulated in float64 one tile at a time.
+    ## the mean and squared deviations of each tile are merged into the running ones (Chan et al.),
+    ## which does not cancel like E[x^2] - E[x]^2 for data far from zero
+    n = 0
+    dmin = np.inf
+    dmax = -np.inf
+    dmean = 0.0
+    m2 = 0.0
+    peak = 0.0
+    for tile in tiles():
+        if limit is not None:
+            peak = max(peak, -float(tile.min()), float(tile.max()))
+        t = convert(tile).astype(np.float64).ravel()
+        k = t.size
+        mean = t.mean()
+        d = t - mean
+        delta = mean - dmean
+        dmean += delta*k/(n + k)
+        m2 += np.dot(d, d) + delta**2*n*k/(n + k)
+        n += k
+        dmin = min(dmin, t.min())
+        dmax = max(dmax, t.max())
+    rms = np.sqrt(m2/n)
+    if limit is not None and peak > limit:
+        print('# Warning: values up to {:g} do not fit in float16 and are clipped to +-{:g}'.format(peak, limit)
+              , file=sys.stderr)
+
+    header = make_header((nz, ny, nx), (ax, ay, az), (alpha, beta, gamma), dtype=dtype
+                        , dmin=dmin, dmax=dmax, dmean=dmean, rms=rms)
+    f.write(header_struct.pack(*list(header)))
+    for tile in tiles():
+        f.write(convert(tile).reshape(-1).view(np.uint8))
@@ -0,0 +1,75 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_process_group(local_rank, nprocs, nnodes=1, node_rank=0, master_addr='127.0.0.1', master_port=29500
+                       , backend='gloo', use_cuda=False):
+    # one process per local worker, ranks are numbered node by node
+    rank = node_rank * nprocs + local_rank
+    world_size = nnodes * nprocs
+    init_method = 'tcp://{}:{}'.format(master_addr, master_port)
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+    return rank, world_size
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def parallelize(model, use_cuda=False, distributed=True):
+    # both wrappers keep the model under .module, so checkpoints keep the same "module." keys.
+    # models that are only evaluated, like a distillation teacher, pass distributed=False
+    if distributed and is_distributed():
+        if use_cuda:
+            device = torch.cuda.current_device()
+            model = model.cuda(device)
+            return nn.parallel.DistributedDataParallel(model, device_ids=[device])
+        return nn.parallel.DistributedDataParallel(model)
+
+    # uses every visible device, on CPU it simply calls the wrapped model
+    model = nn.DataParallel(model)
+    if use_cuda:
+        model = model.cuda()
+    return model
+
+
+def all_reduce_mean(value, n):
+    """ Mean of value over all processes, weighted by the number of samples n seen by each process. """
+    if not is_distributed():
+        return value
+    t = torch.tensor([value * n, n], dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        t = t.cuda()
+    dist.all_reduce(t)
+    return (t[0] / t[1]).item()
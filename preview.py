@@ -0,0 +1,63 @@
+from __future__ import print_function, division
+
+import os
+import sys
+import threading
+
+"""
+PNG/JPEG previews of denoised micrographs for quality control, written in the background.
+
+Each micrograph is Fourier binned so its longest side is at most size pixels, standardized, quantized to
+8 bits over +-3 standard deviations and encoded by a pool of threads. The FFT, the quantization and the
+encoders release the GIL, so previews are written while the next micrographs are denoised. At most
+2 x workers micrographs are queued, submit blocks until one of them is written when the queue is full.
+"""
+
+
+class PreviewWriter:
+    def __init__(self, size=512, format_='png', workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self.size = size
+        self.format_ = format_
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.Semaphore(2*workers)
+        self.errors = []
+
+    def write(self, x, path):
+        # runs on a pool thread
+        from PIL import Image
+        from utils.image import thumbnail, standardize, quantize
+        try:
+            y = thumbnail(x, self.size) if self.size > 0 else x
+            if y is x:
+                # standardize works in place
+                y = x.copy()
+            y, _, _ = standardize(y)
+            im = Image.fromarray(quantize(y))
+            im.save(path, 'jpeg' if self.format_ in ['jpg', 'jpeg'] else 'png')
+        except Exception as e:
+            self.errors.append((path, e))
+        finally:
+            self.slots.release()
+
+    def submit(self, x, path):
+        """ Write a preview of x to path in the background, x must not be changed afterwards. """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.slots.acquire()
+        self.pool.submit(self.write, x, path)
+
+    def close(self):
+        """ Wait for the queued previews and report the ones that failed. """
+        self.pool.shutdown(wait=True)
+        for path, e in self.errors:
+            print('# failed to write preview {}: {}'.format(path, e), file=sys.stderr)
+        return len(self.errors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
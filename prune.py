@@ -0,0 +1,256 @@
+from __future__ import print_function, division
+
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+"""
+Structured channel pruning of the U-Net denoisers.
+
+Convolutions are named 'block.k' for the k-th convolution of the block, e.g. 'dec5.1'. For every
+convolution, the *_INPUTS tables list the convolutions whose outputs are concatenated to form its
+input, None stands for the one channel input micrograph. Removing an output channel of a convolution
+therefore also removes the matching input channel of every convolution reading it, including the
+skip connections into the decoder. Pruned layers are smaller modules of the same model class.
+"""
+
+# UDenoiseNet, UDenoiseNetMaxpool and UDenoiseNetPre
+UNET_INPUTS = {'enc1.0': [None]
+              , 'enc2.0': ['enc1.0']
+              , 'enc3.0': ['enc2.0']
+              , 'enc4.0': ['enc3.0']
+              , 'enc5.0': ['enc4.0']
+              , 'enc6.0': ['enc5.0']
+              , 'dec5.0': ['enc6.0', 'enc4.0']
+              , 'dec5.1': ['dec5.0']
+              , 'dec4.0': ['dec5.1', 'enc3.0']
+              , 'dec4.1': ['dec4.0']
+              , 'dec3.0': ['dec4.1', 'enc2.0']
+              , 'dec3.1': ['dec3.0']
+              , 'dec2.0': ['dec3.1', 'enc1.0']
+              , 'dec2.1': ['dec2.0']
+              , 'dec1.0': ['dec2.1', None]
+              , 'dec1.1': ['dec1.0']
+              , 'dec1.2': ['dec1.1']
+              }
+
+# UDenoiseNetSmall
+SMALL_INPUTS = {'enc1.0': [None]
+               , 'enc2.0': ['enc1.0']
+               , 'enc3.0': ['enc2.0']
+               , 'enc4.0': ['enc3.0']
+               , 'dec3.0': ['enc4.0', 'enc2.0']
+               , 'dec3.1': ['dec3.0']
+               , 'dec2.0': ['dec3.1', 'enc1.0']
+               , 'dec2.1': ['dec2.0']
+               , 'dec1.0': ['dec2.1', None]
+               , 'dec1.1': ['dec1.0']
+               , 'dec1.2': ['dec1.1']
+               }
+
+# the output convolution always keeps its single channel
+OUTPUT = 'dec1.2'
+
+
+def channel_graph(model):
+    name = type(model).__name__
+    if name in ('UDenoiseNet', 'UDenoiseNetMaxpool', 'UDenoiseNetPre'):
+        return UNET_INPUTS
+    elif name == 'UDenoiseNetSmall':
+        return SMALL_INPUTS
+    raise Exception('Channel pruning is not supported for ' + name)
+
+
+def find_convs(model):
+    # map 'block.k' to (block, index of the conv, index of the following BatchNorm or None)
+    convs = {}
+    for block_name, block in model.named_children():
+        if not isinstance(block, nn.Sequential):
+            continue
+        k = 0
+        for i, layer in enumerate(block):
+            if isinstance(layer, nn.Conv2d):
+                bn = None
+                if i + 1 < len(block) and isinstance(block[i + 1], nn.BatchNorm2d):
+                    bn = i + 1
+                convs['{}.{}'.format(block_name, k)] = (block, i, bn)
+                k += 1
+    return convs
+
+
+def channel_importance(model, criterion='bn'):
+    """
+    Importance of every output channel of the prunable convolutions. With criterion='bn' this is the
+    absolute BatchNorm scale (network slimming), layers without BatchNorm fall back to the L1 norm
+    of the filters as does criterion='l1'.
+    """
+    graph = channel_graph(model)
+    convs = find_convs(model)
+    scores = {}
+    for name in graph:
+        if name == OUTPUT:
+            continue
+        block, i, bn = convs[name]
+        if criterion == 'bn' and bn is not None and block[bn].affine:
+            score = block[bn].weight.detach().abs()
+        else:
+            score = block[i].weight.detach().abs().sum((1, 2, 3))
+        scores[name] = score.float().cpu()
+    return scores
+
+
+def select_channels(scores, ratio=0.5, scope='global', min_channels=8):
+    """
+    Channels to keep in every layer, removing about ratio of all channels. With scope='layer' every
+    layer loses the same fraction, with scope='global' scores are divided by their layer mean and a
+    single threshold is applied, so layers with many weak channels lose more of them.
+    """
+    keep = {}
+    if scope == 'global':
+        normalized = {name: s / s.mean().clamp(min=1e-12) for name, s in scores.items()}
+        pooled = torch.cat(list(normalized.values()))
+        k = int(round(ratio * len(pooled)))
+        threshold = pooled.sort()[0][k - 1] if k > 0 else -1
+        for name, s in normalized.items():
+            n = max(min(min_channels, len(s)), int((s > threshold).sum()))
+            keep[name] = s.argsort(descending=True)[:n].sort()[0]
+    elif scope == 'layer':
+        for name, s in scores.items():
+            n = max(min(min_channels, len(s)), int(round(len(s) * (1 - ratio))))
+            keep[name] = s.argsort(descending=True)[:n].sort()[0]
+    else:
+        raise Exception('Unknown pruning scope: ' + scope)
+    return keep
+
+
+def input_channels(name, graph, convs, keep):
+    # indices of the kept input channels of a convolution, the sources are concatenated in order
+    index = []
+    offset = 0
+    for source in graph[name]:
+        if source is None:
+            n = 1
+            kept = torch.arange(1)
+        else:
+            block, i, _ = convs[source]
+            n = block[i].out_channels
+            kept = keep.get(source, torch.arange(n))
+        index.append(kept + offset)
+        offset += n
+    return torch.cat(index)
+
+
+def conv_like(conv, out_channels, in_channels):
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding
+                    , dilation=conv.dilation, bias=conv.bias is not None, padding_mode=conv.padding_mode)
+    return new.train(conv.training)
+
+
+def bn_like(bn, num_features):
+    new = nn.BatchNorm2d(num_features, eps=bn.eps, momentum=bn.momentum, affine=bn.affine
+                         , track_running_stats=bn.track_running_stats)
+    return new.train(bn.training)
+
+
+def prune_model(model, keep):
+    """ Replace the layers of model in place by their pruned versions. Returns the model. """
+    graph = channel_graph(model)
+    convs = find_convs(model)
+
+    # every slice is taken from the original layers before any of them is replaced
+    replaced = []
+    with torch.no_grad():
+        for name in graph:
+            block, i, bn = convs[name]
+            conv = block[i]
+            out_index = keep.get(name, torch.arange(conv.out_channels))
+            in_index = input_channels(name, graph, convs, keep)
+
+            new = conv_like(conv, len(out_index), len(in_index)).to(conv.weight.device, conv.weight.dtype)
+            new.weight.copy_(conv.weight[out_index][:, in_index])
+            if conv.bias is not None:
+                new.bias.copy_(conv.bias[out_index])
+            replaced.append((block, i, new))
+
+            if bn is not None:
+                norm = block[bn]
+                new_bn = bn_like(norm, len(out_index)).to(conv.weight.device)
+                if norm.affine:
+                    new_bn.weight.copy_(norm.weight[out_index])
+                    new_bn.bias.copy_(norm.bias[out_index])
+                if norm.track_running_stats:
+                    new_bn.running_mean.copy_(norm.running_mean[out_index])
+                    new_bn.running_var.copy_(norm.running_var[out_index])
+                    new_bn.num_batches_tracked.copy_(norm.num_batches_tracked)
+                replaced.append((block, bn, new_bn))
+
+    for block, i, layer in replaced:
+        block[i] = layer
+
+    return model
+
+
+def resize_to_state_dict(model, state):
+    """
+    Resize the Conv2d and BatchNorm2d layers of model to the parameter shapes in state, so the
+    state dict of a pruned model can be loaded into a freshly constructed one.
+    """
+    for name, module in list(model.named_modules()):
+        key = name + '.weight'
+        if key not in state:
+            continue
+        # parameters of another kind of layer are left for load_state_dict to report
+        shape = state[key].shape
+        if isinstance(module, nn.Conv2d) and len(shape) == 4 and tuple(shape) != tuple(module.weight.shape):
+            new = conv_like(module, shape[0], shape[1] * module.groups)
+        elif isinstance(module, nn.BatchNorm2d) and len(shape) == 1 and shape[0] != module.num_features:
+            new = bn_like(module, shape[0])
+        else:
+            continue
+        parent_name, _, child = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, new.to(module.weight.device))
+    return model
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def count_macs(model, shape=(1, 1, 1024, 1024)):
+    """ Multiply-accumulates of the convolutions in one forward pass over an input of this shape. """
+    total = [0]
+
+    def hook(module, input, output):
+        k = module.kernel_size[0] * module.kernel_size[1]
+        total[0] += output.numel() * module.in_channels // module.groups * k
+
+    device = next(model.parameters()).device
+    hooks = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, nn.Conv2d)]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(shape, device=device))
+    finally:
+        for h in hooks:
+            h.remove()
+    return total[0]
+
+
+def measure_latency(model, shape=(1, 1, 1024, 1024), repeats=5):
+    """ Median wall time of a forward pass in seconds, after one warm up pass. """
+    device = next(model.parameters()).device
+    x = torch.randn(shape, device=device)
+    times = []
+    with torch.no_grad():
+        model(x)
+        for _ in range(repeats):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            tic = time.time()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - tic)
+    return float(np.median(times))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import copy
+
+name = 'prune'
+help = 'remove the least important conv channels of a trained U-Net denoiser and fine-tune the slimmer model'
+
+
+def add_arguments(parser):
+    parser.add_argument('-m', '--model', required=True, help='trained model to prune')
+    parser.add_argument('-ret', '--retraining', choices=['finetune', 'abinit', 'abinitMaxpool', 'abinitBFNet', 'abinitBFNonMaxpool'],
+                        help='force the model class chosen for training, detected from the checkpoint by default')
+    parser.add_argument('-o', '--output', required=True, help='path to write the pruned model to')
+
+    parser.add_argument('--prune', type=float, default=0.5, help='fraction of the conv channels to remove (default: 0.5)')
+    parser.add_argument('--criterion', choices=['bn', 'l1'], default='bn',
+                        help='channel importance, the BatchNorm scale or the L1 norm of the filters. layers without BatchNorm always use the L1 norm (default: bn)')
+    parser.add_argument('--scope', choices=['global', 'layer'], default='global',
+                        help='rank channels against all layers, or remove the same fraction from every layer (default: global)')
+    parser.add_argument('--min-channels', type=int, default=8, help='keep at least this many channels per layer (default: 8)')
+
+    # fine-tuning by distillation from the unpruned model
+    parser.add_argument('-a', '--dir-a', nargs='+',
+                        help='directories of micrographs to fine-tune on, the pruned model is fit to the outputs of the unpruned one. not fine-tuned if not given')
+    parser.add_argument('--teacher-cache',
+                        help='directory to cache the outputs of the unpruned model in (default: <model>_outputs next to the checkpoint)')
+    parser.add_argument('--num-epochs', type=int, default=5, help='number of fine-tuning epochs (default: 5)')
+    parser.add_argument('--lr', type=float, default=0.001, help='fine-tuning learning rate (default: 0.001)')
+    parser.add_argument('--optim', choices=['adam', 'adagrad', 'sgd'], default='adam', help='fine-tuning optimizer (default: adam)')
+    parser.add_argument('-c', '--crop', type=int, default=256, help='fine-tuning crop size (default: 256)')
+    parser.add_argument('--batch-size', type=int, default=4, help='fine-tuning batch size (default: 4)')
+    parser.add_argument('--holdout', type=float, default=0.1, help='fraction of micrographs held out for validation (default: 0.1)')
+    parser.add_argument('--num-workers', type=int, default=0, help='number of data loading workers (default: 0)')
+
+    parser.add_argument('--bench-size', type=int, default=1024,
+                        help='size of the square image used to measure FLOPs and latency (default: 1024)')
+    parser.add_argument('-d', '--device', default=0, help='which device to use, set to -1 to force CPU (default: 0)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0,
+                        help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+
+    return parser
+
+
+def describe(model, shape):
+    import prune
+    return prune.count_parameters(model), prune.count_macs(model, shape), prune.measure_latency(model, shape)
+
+
+def main(args):
+    import numpy as np
+    import torch
+    import cuda
+    import prune
+    import registry
+    import denoise as dn
+    from torch_topaz import set_num_threads
+    from denoise_cmd import load_trained_model, make_distill_datasets, seed_everything
+
+    seed_everything()
+    set_num_threads(args.num_threads)
+    use_cuda = cuda.set_device(args.device)
+
+    print('# loading model:', args.model, file=sys.stderr)
+    model = load_trained_model(args.model, use_cuda=use_cuda, retraining=args.retraining)
+    net = model.module
+
+    shape = (1, 1, args.bench_size, args.bench_size)
+    before = describe(net, shape)
+
+    teacher = None
+    if args.dir_a is not None:
+        teacher = copy.deepcopy(model)
+
+    scores = prune.channel_importance(net, criterion=args.criterion)
+    keep = prune.select_channels(scores, ratio=args.prune, scope=args.scope, min_channels=args.min_channels)
+    prune.prune_model(net, keep)
+
+    for layer, index in keep.items():
+        print('# {} keeps {} of {} channels'.format(layer, len(index), len(scores[layer])), file=sys.stderr)
+
+    after = describe(net, shape)
+
+    if teacher is not None:
+        path, _ = registry.resolve(args.model)
+        cache_dir = args.teacher_cache
+        if cache_dir is None:
+            cache_dir = os.path.splitext(path)[0] + '_outputs'
+
+        dset_train = []
+        dset_val = []
+        for dir_a in args.dir_a:
+            random = np.random.RandomState(44444)
+            dataset_train, dataset_val = make_distill_datasets(dir_a, None, teacher, cache_dir
+                                                               , since=os.path.getmtime(path)
+                                                               , crop=args.crop, random=random
+                                                               , holdout=args.holdout, use_cuda=use_cuda)
+            dset_train.append(dataset_train)
+            dset_val.append(dataset_val)
+        dataset_train = dset_train[0]
+        dataset_val = dset_val[0]
+        for i in range(1, len(dset_train)):
+            dataset_train.x += dset_train[i].x
+            dataset_train.y += dset_train[i].y
+            dataset_val.x += dset_val[i].x
+            dataset_val.y += dset_val[i].y
+        del teacher
+
+        print('epoch', 'loss_train', 'loss_val')
+        iterator = dn.train_distill(model, dataset_train, lr=args.lr
+                                    , optim=args.optim
+                                    , batch_size=args.batch_size
+                                    , num_epochs=args.num_epochs
+                                    , criteria='L2'
+                                    , dataset_val=dataset_val
+                                    , use_cuda=use_cuda
+                                    , num_workers=args.num_workers
+                                    )
+        for epoch, loss_train, loss_val in iterator:
+            print(epoch, loss_train, loss_val)
+            sys.stdout.flush()
+
+    model.eval()
+    # same "module." keys as the training checkpoints, so -m loads it like any other model
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    torch.save({'header': dn.architecture_header(model), 'model': model.state_dict()}, args.output)
+    print('# wrote', args.output, file=sys.stderr)
+
+    print('# {:>10} {:>12} {:>12} {:>12}'.format('', 'parameters', 'GMAC', 'latency (s)'), file=sys.stderr)
+    for label, (params, macs, latency) in (('original', before), ('pruned', after)):
+        print('# {:>10} {:>12d} {:>12.2f} {:>12.3f}'.format(label, params, macs / 1e9, latency), file=sys.stderr)
+    print('# FLOPs reduced {:.1f}x, latency reduced {:.1f}x on {}x{}'.format(
+          before[1] / after[1], before[2] / after[2], args.bench_size, args.bench_size), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
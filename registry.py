@@ -0,0 +1,159 @@
+from __future__ import print_function, division
+
+import os
+import json
+import shutil
+import hashlib
+
+"""
+Registry of trained denoising models.
+
+Names map to files in the model directory, $SAID_MODEL_DIR or pre_trained_models/ next to this file.
+The directory holds a registry.json of the form
+
+    {"unet": {"file": "unet_L2_v0.2.2.sav", "sha256": "...", "arch": "UDenoiseNet", "kwargs": {...}}}
+
+where sha256, arch and kwargs are optional. Files are checked against their checksum the first time they
+are loaded in a process, and loaded weights are cached for the life of the process.
+"""
+
+MODEL_DIR_ENV = 'SAID_MODEL_DIR'
+INDEX_NAME = 'registry.json'
+
+# model names inherited from topaz, the files are not shipped and have to be placed in the model directory
+BUILTIN = {'unet': {'file': 'unet_L2_v0.2.2.sav', 'arch': 'UDenoiseNet', 'kwargs': {'base_width': 11, 'top_width': 5}}
+          , 'unet-v0.2.1': {'file': 'unet_L2_v0.2.1.sav', 'arch': 'UDenoiseNet', 'kwargs': {'base_width': 7, 'top_width': 3}}
+          , 'fcnn': {'file': 'fcnn_L1_v0.2.2.sav', 'arch': 'DenoiseNet2', 'kwargs': {'base_filters': 64, 'width': 11}}
+          }
+
+_cache = {}
+
+
+def model_dir():
+    directory = os.environ.get(MODEL_DIR_ENV)
+    if not directory:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pre_trained_models')
+    return directory
+
+
+def read_index(directory=None):
+    if directory is None:
+        directory = model_dir()
+    index = {name: dict(entry) for name, entry in BUILTIN.items()}
+    path = os.path.join(directory, INDEX_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            index.update(json.load(f))
+    return index
+
+
+def write_index(index, directory=None):
+    if directory is None:
+        directory = model_dir()
+    # only the entries that differ from the builtin ones are written
+    entries = {name: entry for name, entry in index.items() if BUILTIN.get(name) != entry}
+    path = os.path.join(directory, INDEX_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entries, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def resolve(name, directory=None):
+    """ Path and registry entry of a model name, a path to an existing file is returned as is. """
+    if os.path.isfile(name):
+        return name, None
+    if directory is None:
+        directory = model_dir()
+    index = read_index(directory)
+    if name in index:
+        entry = index[name]
+        path = os.path.join(directory, entry['file'])
+        if not os.path.isfile(path):
+            raise Exception('Model {} is registered but {} does not exist'.format(name, path))
+        return path, entry
+    raise Exception('Unknown model: {} is neither a file nor registered in {}'.format(name, directory))
+
+
+def sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def torch_load(path):
+    import torch
+    # memory map the weights so only the pages that are used are read, files in the legacy
+    # (pre zip) format and torch versions without mmap support fall back to a regular load
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location='cpu')
+
+
+def load_checkpoint(name, directory=None):
+    """
+    Load a registered model name or checkpoint path on CPU. Registry entries with an architecture are
+    returned as {'header': ..., 'model': state_dict} like new training checkpoints. The result is cached
+    per process and must not be modified, load_state_dict copies the weights into the model.
+    """
+    path, entry = resolve(name, directory=directory)
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    if key in _cache:
+        return _cache[key]
+
+    if entry is not None and entry.get('sha256'):
+        checksum = sha256(path)
+        if checksum != entry['sha256']:
+            raise Exception('Checksum mismatch for model {}: expected {}, found {}'.format(name, entry['sha256'], checksum))
+
+    checkpoint = torch_load(path)
+    if entry is not None and entry.get('arch') is not None:
+        if isinstance(checkpoint, dict) and 'header' not in checkpoint:
+            state = checkpoint['model'] if 'model' in checkpoint else checkpoint
+            header = {'format': 'said-model-v1', 'arch': entry['arch'], 'kwargs': entry.get('kwargs', {})}
+            checkpoint = {'header': header, 'model': state}
+
+    _cache[key] = checkpoint
+    return checkpoint
+
+
+def add_model(name, path, directory=None, arch=None, kwargs=None):
+    """ Copy a checkpoint into the model directory and register it under name with its checksum. """
+    if directory is None:
+        directory = model_dir()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    target = os.path.join(directory, os.path.basename(path))
+    if os.path.abspath(target) != os.path.abspath(path):
+        shutil.copyfile(path, target)
+
+    entry = {'file': os.path.basename(path), 'sha256': sha256(target)}
+    if arch is not None:
+        entry['arch'] = arch
+        entry['kwargs'] = kwargs or {}
+
+    index = read_index(directory)
+    index[name] = entry
+    write_index(index, directory)
+    return entry
+
+
+def verify(directory=None):
+    """ Yields (name, status) for every registered model, status is ok, missing, unchecked or mismatch. """
+    if directory is None:
+        directory = model_dir()
+    for name, entry in sorted(read_index(directory).items()):
+        path = os.path.join(directory, entry['file'])
+        if not os.path.isfile(path):
+            status = 'missing'
+        elif not entry.get('sha256'):
+            status = 'unchecked'
+        elif sha256(path) == entry['sha256']:
+            status = 'ok'
+        else:
+            status = 'mismatch'
+        yield name, status
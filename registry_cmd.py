@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import sys
+
+name = 'registry'
+help = 'list, add and verify the trained models that can be passed to -m by name'
+
+
+def add_arguments(parser):
+    parser.add_argument('--model-dir', help='model directory (default: $SAID_MODEL_DIR or pre_trained_models/)')
+    parser.add_argument('--add', nargs=2, metavar=('NAME', 'PATH'),
+                        help='copy the checkpoint at PATH into the model directory and register it as NAME with its checksum')
+    parser.add_argument('--verify', action='store_true', help='check every registered model file against its checksum')
+    return parser
+
+
+def main(args):
+    import registry
+
+    directory = args.model_dir or registry.model_dir()
+
+    if args.add is not None:
+        name, path = args.add
+        entry = registry.add_model(name, path, directory=directory)
+        print('# registered {} as {} (sha256 {})'.format(path, name, entry['sha256']), file=sys.stderr)
+
+    if args.verify:
+        failed = False
+        for name, status in registry.verify(directory=directory):
+            print(name, status)
+            failed = failed or status == 'mismatch'
+        if failed:
+            sys.exit(1)
+    elif args.add is None:
+        for name, entry in sorted(registry.read_index(directory).items()):
+            print(name, entry['file'], entry.get('sha256', '-'))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
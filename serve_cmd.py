@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+
+name = 'serve'
+help = 'load denoising models once and denoise the micrographs of jobs sent over a Unix socket, see submit_cmd.py'
+
+
+def add_arguments(parser):
+    parser.add_argument('-m', '--model', nargs='+', default=['unet'],
+                        help='trained denoising model(s), given as checkpoint paths or registered names. the outputs of several models are averaged (default: unet)')
+    parser.add_argument('-ret', '--retraining', choices=['finetune', 'abinit', 'abinitMaxpool', 'abinitBFNet', 'abinitBFNonMaxpool'],
+                        help='force the model class, detected from the checkpoint by default')
+    parser.add_argument('--socket', default='said-denoise.sock', help='path of the Unix socket to listen on (default: said-denoise.sock)')
+
+    parser.add_argument('-s', '--patch-size', type=int, default=-1,
+                        help='denoises micrographs in patches of this size. not used if <1 (default: -1)')
+    parser.add_argument('-p', '--patch-padding', type=int, default=512,
+                        help='padding around each patch to remove edge artifacts (default: 512)')
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='number of patches of the same shape passed through the model together (default: 4)')
+    parser.add_argument('--max-images', type=int, default=8,
+                        help='maximum number of queued micrographs denoised together (default: 8)')
+
+    parser.add_argument('-d', '--device', default=0, help='which device to use, set to -1 to force CPU (default: 0)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0,
+                        help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+
+    return parser
+
+
+def main(args):
+    import cuda
+    import server
+    from torch_topaz import set_num_threads
+    from denoise_cmd import load_trained_model
+
+    set_num_threads(args.num_threads)
+    use_cuda = cuda.set_device(args.device)
+    print('# using device={} with cuda={}'.format(args.device, use_cuda), file=sys.stderr)
+
+    models = []
+    for arg in args.model:
+        print('# Loading model:', arg, file=sys.stderr)
+        models.append(load_trained_model(arg, use_cuda=use_cuda, retraining=args.retraining))
+
+    denoiser = server.DenoiseServer(models, use_cuda=use_cuda, patch_size=args.patch_size
+                                    , padding=args.patch_padding, batch_size=args.batch_size
+                                    , max_images=args.max_images)
+    server.serve(denoiser, os.path.abspath(args.socket))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,252 @@
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import socketserver
+import itertools
+import queue
+
+"""
+Persistent denoising server.
+
+The models are loaded once and jobs are sent over a Unix socket. A job is one JSON line
+
+    {"inputs": ["/data/a.mrc", ...], "output": "/data/denoised", "suffix": "", "format": "mrc", "normalize": false}
+
+and the server streams JSON lines back on the same connection: a queued event, a done or error event
+for every micrograph, and a finished event when the whole job is written. {"command": "status"} and
+{"command": "shutdown"} are answered with a single line. A single worker thread runs the models, it
+takes every micrograph queued at that moment, up to max_images, and batches their patches together.
+"""
+
+JOB_OPTIONS = {'output': None, 'suffix': '', 'format': 'mrc', 'mrc_dtype': 'float32', 'normalize': False, 'cutoff': 0}
+
+
+class Job:
+    def __init__(self, job_id, inputs, options):
+        self.id = job_id
+        self.inputs = inputs
+        self.options = options
+        self.events = queue.Queue()
+        self.remaining = len(inputs)
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def report(self, event, **kwargs):
+        kwargs['event'] = event
+        kwargs['job'] = self.id
+        self.events.put(kwargs)
+
+    def complete(self, failed=False):
+        with self.lock:
+            self.remaining -= 1
+            if failed:
+                self.failed += 1
+            finished = self.remaining == 0
+        if finished:
+            self.report('finished', completed=len(self.inputs) - self.failed, failed=self.failed)
+
+
+class DenoiseServer:
+    def __init__(self, models, use_cuda=False, patch_size=-1, padding=128, batch_size=4, max_images=8):
+        self.models = models
+        self.use_cuda = use_cuda
+        self.patch_size = patch_size
+        self.padding = padding
+        self.batch_size = batch_size
+        self.max_images = max_images
+
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+        self.processed = 0
+        self.started = time.time()
+        self.worker = None
+
+    def submit(self, request):
+        inputs = request.get('inputs', [])
+        options = {key: request.get(key, default) for key, default in JOB_OPTIONS.items()}
+        if options['format'] in ('png', 'jpg'):
+            # always normalize png and jpg format
+            options['normalize'] = True
+
+        job = Job(next(self.ids), inputs, options)
+        job.report('queued', count=len(inputs))
+        if len(inputs) == 0:
+            job.report('finished', completed=0, failed=0)
+        if options['output'] and not os.path.exists(options['output']):
+            os.makedirs(options['output'])
+        for path in inputs:
+            self.queue.put((job, path))
+        return job
+
+    def status(self):
+        return {'event': 'status', 'queued': self.queue.qsize(), 'processed': self.processed
+                , 'uptime': time.time() - self.started, 'models': len(self.models)}
+
+    def start(self):
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.queue.put(None)
+        if self.worker is not None:
+            self.worker.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # everything queued in the meantime is denoised together
+            items = [item]
+            while len(items) < self.max_images:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                items.append(item)
+            self.process(items)
+
+    def process(self, items):
+        import numpy as np
+        import denoise as dn
+        from utils.data.loader import load_image
+        from utils.image import save_image
+        from denoise_cmd import preprocess_image, restore_image, output_path
+
+        tic = time.time()
+        loaded = []
+        for job, path in items:
+            try:
+                mic = np.array(load_image(path), copy=False).astype(np.float32)
+                x, mu, std = preprocess_image(mic, cutoff=job.options['cutoff'], use_cuda=self.use_cuda)
+                loaded.append((job, path, x, mu, std))
+            except Exception as e:
+                job.report('error', input=path, message=str(e))
+                job.complete(failed=True)
+
+        images = [x for _, _, x, _, _ in loaded]
+        denoised = [0] * len(images)
+        try:
+            for model in self.models:
+                outputs = dn.denoise_batch(model, images, patch_size=self.patch_size, padding=self.padding
+                                           , batch_size=self.batch_size)
+                denoised = [a + b for a, b in zip(denoised, outputs)]
+        except Exception as e:
+            # a failed batch fails its micrographs, the server keeps running
+            for job, path, _, _, _ in loaded:
+                job.report('error', input=path, message=str(e))
+                job.complete(failed=True)
+            return
+
+        elapsed = (time.time() - tic) / max(len(loaded), 1)
+        for (job, path, _, mu, std), mic in zip(loaded, denoised):
+            options = job.options
+            try:
+                mic = restore_image(mic / len(self.models), mu, std, normalize=options['normalize'])
+                outpath = output_path(path, options['output'], suffix=options['suffix'], format_=options['format'])
+                save_image(mic, outpath, dtype=options['mrc_dtype'])
+                job.report('done', input=path, output=outpath, seconds=elapsed)
+                job.complete()
+            except Exception as e:
+                job.report('error', input=path, message=str(e))
+                job.complete(failed=True)
+            self.processed += 1
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def send(self, event):
+        self.wfile.write((json.dumps(event) + '\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode())
+        except ValueError as e:
+            self.send({'event': 'error', 'message': 'invalid request: ' + str(e)})
+            return
+
+        denoiser = self.server.denoiser
+        command = request.get('command', 'denoise')
+        if command == 'status':
+            self.send(denoiser.status())
+        elif command == 'shutdown':
+            self.send({'event': 'shutdown'})
+            # shutdown waits for serve_forever to return, so it cannot run on this thread
+            threading.Thread(target=self.server.shutdown).start()
+        elif command == 'denoise':
+            job = denoiser.submit(request)
+            print('# job {}: {} micrographs'.format(job.id, len(job.inputs)), file=sys.stderr)
+            while True:
+                event = job.events.get()
+                try:
+                    self.send(event)
+                except (IOError, OSError):
+                    # the client went away, the job still runs to completion
+                    pass
+                if event['event'] == 'finished':
+                    break
+        else:
+            self.send({'event': 'error', 'message': 'unknown command: ' + str(command)})
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(denoiser, path):
+    """ Serve denoising jobs on the Unix socket at path until a shutdown request. """
+    if os.path.exists(path):
+        # a socket left behind by a server that is no longer running is replaced
+        try:
+            connect(path).close()
+        except (IOError, OSError):
+            os.remove(path)
+        else:
+            raise Exception('A server is already listening on ' + path)
+
+    server = UnixServer(path, RequestHandler)
+    server.denoiser = denoiser
+    denoiser.start()
+    print('# listening on', path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        denoiser.stop()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def request(path, message):
+    """ Send a request to the server at path and yield the events it streams back. """
+    sock = connect(path)
+    try:
+        f = sock.makefile('rwb')
+        f.write((json.dumps(message) + '\n').encode())
+        f.flush()
+        for line in f:
+            yield json.loads(line.decode())
+    finally:
+        sock.close()
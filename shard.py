@@ -0,0 +1,153 @@
+from __future__ import print_function, division
+
+import os
+import glob
+import json
+import time
+
+"""
+Deterministic sharding of denoising jobs over several processes or nodes.
+
+Micrographs are assigned greedily, largest first, to the shard with the fewest pixels so far, with the
+pixel count read from the MRC header. The assignment only depends on the set of paths and their sizes,
+so every shard computes the same partition without talking to the others. A stack is split into
+contiguous section ranges instead. Each shard writes a completion marker listing its outputs once they
+are all written, shard_cmd.py checks the markers and merges stack parts.
+"""
+
+MARKER = 'said_shard_{:03d}_of_{:03d}.json'
+
+
+def read_mrc_header(path):
+    import mrc
+    with mrc.open_file(path) as f:
+        content = f.read(1024)
+    return mrc.MRCHeader._make(mrc.header_struct.unpack(content))
+
+
+def count_pixels(path):
+    """ Number of pixels of the image at path from its MRC header, other formats are weighted by file size. """
+    import mrc
+    if mrc.is_mrc(path):
+        header = read_mrc_header(path)
+        return header.nx * header.ny * max(header.nz, 1)
+    return os.path.getsize(path)
+
+
+def partition(paths, num_shards, weights=None):
+    """ Split paths into num_shards sorted lists of about equal total weight. """
+    if weights is None:
+        weights = [count_pixels(path) for path in paths]
+    # heaviest first, ties broken by path so the input order does not matter
+    order = sorted(range(len(paths)), key=lambda i: (-weights[i], paths[i]))
+    loads = [0] * num_shards
+    assigned = [[] for _ in range(num_shards)]
+    for i in order:
+        k = min(range(num_shards), key=lambda k: (loads[k], k))
+        loads[k] += weights[i]
+        assigned[k].append(i)
+    return [sorted(paths[i] for i in index) for index in assigned]
+
+
+def section_range(num_sections, shard_index, num_shards):
+    """ Contiguous [start, end) range of the sections of a stack processed by this shard. """
+    start = num_sections * shard_index // num_shards
+    end = num_sections * (shard_index + 1) // num_shards
+    return start, end
+
+
+def read_sections(path, start, end):
+    """ Sections start to end of an MRC stack, reading only those from disk (compressed stacks are decompressed up to end). """
+    import numpy as np
+    import mrc
+
+    header = read_mrc_header(path)
+    dtype = {0: np.int8, 1: np.int16, 2: np.float32, 4: np.complex64, 6: np.uint16, 12: np.float16}[header.mode]
+    section = header.nx * header.ny
+    with mrc.open_file(path) as f:
+        f.seek(1024 + header.next + start * section * mrc.MODE_BYTES[header.mode])
+        x = np.frombuffer(f.read((end - start) * section * mrc.MODE_BYTES[header.mode]), dtype=dtype)
+    return x.reshape(end - start, header.ny, header.nx)
+
+
+def stack_part_path(path, start, end):
+    import mrc
+    root, ext = mrc.splitext(path)
+    return '{}.sections{}-{}{}'.format(root, start, end, ext)
+
+
+def write_plan(path, shards):
+    with open(path, 'w') as f:
+        json.dump({'num_shards': len(shards), 'shards': shards}, f, indent=2)
+
+
+def read_plan(path, shard_index):
+    with open(path) as f:
+        plan = json.load(f)
+    if not 0 <= shard_index < plan['num_shards']:
+        raise Exception('Shard index {} out of range for the {} shards in {}'.format(shard_index, plan['num_shards'], path))
+    return plan['shards'][shard_index], plan['num_shards']
+
+
+def write_marker(directory, shard_index, num_shards, inputs, outputs, sections=None):
+    marker = {'shard': shard_index, 'num_shards': num_shards, 'inputs': inputs, 'outputs': outputs
+              , 'time': time.time()}
+    if sections is not None:
+        marker['sections'] = sections
+    path = os.path.join(directory, MARKER.format(shard_index, num_shards))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(marker, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_markers(directory):
+    markers = []
+    for path in sorted(glob.glob(os.path.join(directory, 'said_shard_*_of_*.json'))):
+        with open(path) as f:
+            markers.append(json.load(f))
+    return markers
+
+
+def verify(directory, num_shards=None):
+    """ Problems with the shards in directory, an empty list if every shard completed and its outputs exist. """
+    markers = read_markers(directory)
+    if num_shards is None:
+        if len(markers) == 0:
+            return ['no shard markers in ' + directory]
+        num_shards = markers[0]['num_shards']
+    markers = {m['shard']: m for m in markers if m['num_shards'] == num_shards}
+
+    problems = []
+    for k in range(num_shards):
+        if k not in markers:
+            problems.append('shard {} of {} has not completed'.format(k, num_shards))
+            continue
+        for output in markers[k]['outputs']:
+            if not os.path.exists(output):
+                problems.append('shard {} output is missing: {}'.format(k, output))
+    return problems
+
+
+def merge_stack(directory, path, num_shards=None):
+    """ Concatenate the section ranges written by the shards of a stack into one MRC file at path. """
+    import numpy as np
+    import mrc
+
+    markers = [m for m in read_markers(directory) if 'sections' in m]
+    if num_shards is None and len(markers) > 0:
+        num_shards = markers[0]['num_shards']
+    markers = [m for m in markers if m['num_shards'] == num_shards]
+    markers.sort(key=lambda m: m['sections'][0])
+    parts = []
+    for m in markers:
+        if len(m['outputs']) == 0:
+            # a shard past the last section writes no part
+            continue
+        x, _, _ = mrc.read(m['outputs'][0])
+        parts.append(x.reshape(-1, x.shape[-2], x.shape[-1]))
+    if len(parts) == 0:
+        raise Exception('No stack parts to merge in ' + directory)
+    # the merged stack keeps the data type of the parts
+    with mrc.open_file(path, 'wb') as f:
+        mrc.write_tiled(f, np.concatenate(parts, axis=0), dtype=parts[0].dtype)
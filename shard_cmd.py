@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import sys
+
+name = 'shard'
+help = 'plan the shards of a denoising job, check that every shard completed and merge the parts of a sharded stack'
+
+
+def add_arguments(parser):
+    parser.add_argument('micrographs', nargs='*', help='micrographs to split with --plan')
+    parser.add_argument('-n', '--num-shards', type=int, help='number of shards, read from the markers if not given for --verify')
+
+    parser.add_argument('--plan', help='write the shard assignment of the micrographs, balanced by pixel count, to this file for denoise_cmd.py --shard-plan')
+    parser.add_argument('--verify', metavar='DIR', help='check the completion markers and outputs of the shards written to this directory')
+    parser.add_argument('--merge-stack', metavar='PATH',
+                        help='with --verify, concatenate the section ranges of a sharded --stack into this MRC file')
+
+    return parser
+
+
+def main(args):
+    import shard
+
+    if args.plan is not None:
+        if args.num_shards is None:
+            raise Exception('--plan requires --num-shards')
+        shards = shard.partition(args.micrographs, args.num_shards)
+        shard.write_plan(args.plan, shards)
+        for k, paths in enumerate(shards):
+            pixels = sum(shard.count_pixels(path) for path in paths)
+            print('# shard {}: {} micrographs, {:.1f} Mpx'.format(k, len(paths), pixels / 1e6), file=sys.stderr)
+
+    if args.verify is not None:
+        problems = shard.verify(args.verify, num_shards=args.num_shards)
+        for problem in problems:
+            print('#', problem, file=sys.stderr)
+        if len(problems) > 0:
+            sys.exit(1)
+        print('# all shards completed', file=sys.stderr)
+
+        if args.merge_stack is not None:
+            shard.merge_stack(args.verify, args.merge_stack, num_shards=args.num_shards)
+            print('# wrote', args.merge_stack, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+
+name = 'submit'
+help = 'send micrographs to a running denoising server (serve_cmd.py) and print its progress'
+
+
+def add_arguments(parser):
+    parser.add_argument('micrographs', nargs='*', help='micrographs to denoise')
+    parser.add_argument('--socket', default='said-denoise.sock', help='Unix socket of the server (default: said-denoise.sock)')
+
+    parser.add_argument('-o', '--output', help='directory to save denoised micrographs')
+    parser.add_argument('--suffix', default='',
+                        help='add this suffix to each output file name. if no output directory is specified, denoised micrographs are written to the same location as the input with a default suffix of ".denoised" (default: none)')
+    parser.add_argument('--format', dest='format_', default='mrc',
+                        help='output format for the images, mrc.gz and mrc.xz write compressed MRC files (default: mrc)')
+    parser.add_argument('--mrc-dtype', choices=['float32', 'float16'], default='float32',
+                        help='data type of MRC outputs, float16 (mode 12) halves their size (default: float32)')
+    parser.add_argument('--normalize', action='store_true', help='normalize the micrographs')
+    parser.add_argument('--pixel-cutoff', type=float, default=0,
+                        help='set pixels >= this number of standard deviations away from the mean to the mean. only used when set > 0 (default: 0)')
+
+    parser.add_argument('--status', action='store_true', help='print the server status and exit')
+    parser.add_argument('--shutdown', action='store_true', help='stop the server')
+
+    return parser
+
+
+def main(args):
+    import server
+
+    if args.status:
+        message = {'command': 'status'}
+    elif args.shutdown:
+        message = {'command': 'shutdown'}
+    else:
+        # the server resolves paths relative to its own working directory
+        message = {'inputs': [os.path.abspath(path) for path in args.micrographs]
+                  , 'output': os.path.abspath(args.output) if args.output else None
+                  , 'suffix': args.suffix
+                  , 'format': args.format_
+                  , 'mrc_dtype': args.mrc_dtype
+                  , 'normalize': args.normalize
+                  , 'cutoff': args.pixel_cutoff
+                  }
+
+    failed = 0
+    count = 0
+    for event in server.request(args.socket, message):
+        kind = event['event']
+        if kind == 'done':
+            count += 1
+            print('# {} of {} completed.'.format(count, len(args.micrographs)), file=sys.stderr, end='\r')
+        elif kind == 'error':
+            print('# error: {} {}'.format(event.get('input', ''), event['message']), file=sys.stderr)
+        elif kind == 'finished':
+            print('', file=sys.stderr)
+            failed = event['failed']
+        print(json.dumps(event))
+        sys.stdout.flush()
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(help)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,253 @@
+from __future__ import print_function, division
+
+import os
+import sys
+
+import numpy as np
+
+from utils.data.loader import load_image
+from utils.image import gaussian_filter, moments
+
+"""
+Chunked HDF5 store for paired training micrographs.
+
+Layout of a store file:
+
+    /                 attrs: format, tile
+    /images/<name>/x  noisy micrograph A, float32, chunked (tile, tile)
+    /images/<name>/y  noisy micrograph B, float32, chunked (tile, tile)
+    /images/<name>/g  optional guidance image, float32, chunked (tile, tile)
+
+Each image dataset carries its own normalization statistics as 'mu' and 'std' attributes, so crops can be
+standardized without reading the whole micrograph. Random crops only touch the chunks they overlap.
+Guidance images are filtered once when the store is built, never during training.
+"""
+
+STORE_FORMAT = 'said-paired-v1'
+
+
+def write_paired_store(path, x_paths, y_paths, g_paths=None, tile=256, compression='gzip', compression_opts=4
+                       , guidance_sigma=0, verbose=True):
+    import h5py
+
+    if g_paths is None:
+        g_paths = [None] * len(x_paths)
+
+    total = len(x_paths)
+    with h5py.File(path, 'w') as f:
+        f.attrs['format'] = STORE_FORMAT
+        f.attrs['tile'] = tile
+        root = f.create_group('images')
+
+        count = 0
+        for x_path, y_path, g_path in zip(x_paths, y_paths, g_paths):
+            name, _ = os.path.splitext(os.path.basename(x_path))
+            if name in root:
+                raise Exception('Duplicate micrograph name in training store: ' + name)
+            group = root.create_group(name)
+
+            images = {}
+            for key, p in (('x', x_path), ('y', y_path), ('g', g_path)):
+                if p is not None:
+                    x = np.array(load_image(p), copy=False).astype(np.float32)
+                    images[key] = (x,) + moments(x)
+
+            if 'g' not in images and guidance_sigma > 0:
+                # filtered average of the normalized pair, already in normalized units
+                x, mu, std = images['x']
+                y, mu_y, std_y = images['y']
+                g = ((x - mu) / std + (y - mu_y) / std_y) / 2
+                g = gaussian_filter(g.astype(np.float32), guidance_sigma)
+                images['g'] = (g, 0.0, 1.0)
+
+            for key, (x, mu, std) in images.items():
+                chunks = (min(tile, x.shape[0]), min(tile, x.shape[1]))
+                d = group.create_dataset(key, data=x, chunks=chunks, compression=compression
+                                         , compression_opts=compression_opts
+                                         , shuffle=compression is not None)
+                d.attrs['mu'] = mu
+                d.attrs['std'] = std
+
+            count += 1
+            if verbose:
+                print('# {} of {} packed.'.format(count, total), file=sys.stderr, end='\r')
+        if verbose:
+            print('', file=sys.stderr)
+
+
+def read_store_names(path):
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        if f.attrs.get('format') != STORE_FORMAT:
+            raise Exception('Not a SaID training store: ' + path)
+        names = sorted(f['images'].keys())
+    return names
+
+
+def image_keys(images, item):
+    # items of an unpaired store are 'name/key' dataset paths
+    return [item]
+
+
+def paired_keys(images, item):
+    # items of a paired store are micrograph names, the guidance image is optional
+    keys = [item + '/x', item + '/y']
+    if 'g' in images[item]:
+        keys.append(item + '/g')
+    return keys
+
+
+class HDFStore:
+    """ Shared access to a chunked HDF5 training store. keys(images, item) lists the datasets forming a sample. """
+
+    def __init__(self, path, items, keys, crop=800, xform=True, preload=False, cutoff=0):
+        import h5py
+
+        self.path = path
+        self.items = items
+        self.crop = crop
+        self.xform = xform
+        self.cutoff = cutoff
+        self.preload = preload
+
+        self._file = None
+        self._pid = None
+
+        # read shapes and normalization stats once, this only touches the metadata
+        self.shape = []
+        self.stats = []
+        with h5py.File(path, 'r') as f:
+            images = f['images']
+            for item in items:
+                item_keys = keys(images, item)
+                d = images[item_keys[0]]
+                self.shape.append(d.shape)
+                self.stats.append([(key, images[key].attrs['mu'], images[key].attrs['std']) for key in item_keys])
+
+            if preload:
+                self.images = {}
+                for stats in self.stats:
+                    for key, mu, std in stats:
+                        self.images[key] = self.normalize(images[key][:], mu, std)
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, each worker reopens the store
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
+    def open(self):
+        pid = os.getpid()
+        if self._file is None or self._pid != pid:
+            import h5py
+            self._file = h5py.File(self.path, 'r')
+            self._pid = pid
+        return self._file
+
+    def normalize(self, x, mu, std):
+        x = x.astype(np.float32, copy=False)
+        x -= mu
+        x /= std
+        if self.cutoff > 0:
+            x[(x < -self.cutoff) | (x > self.cutoff)] = 0
+        return x
+
+    def read_crop(self, i):
+        n, m = self.shape[i]
+        si, ei, sj, ej = 0, n, 0, m
+        if self.crop is not None:
+            size = self.crop
+            si = np.random.randint(n - size + 1)
+            sj = np.random.randint(m - size + 1)
+            ei = si + size
+            ej = sj + size
+
+        crops = []
+        for key, mu, std in self.stats[i]:
+            if self.preload:
+                x = self.images[key][si:ei, sj:ej]
+            else:
+                # slicing the dataset only decompresses the chunks overlapping the crop
+                x = self.normalize(self.open()['images'][key][si:ei, sj:ej], mu, std)
+            crops.append(x)
+        return crops
+
+    def __len__(self):
+        return len(self.items)
+
+
+class HDFImages(HDFStore):
+    """ Random crops from every image in the store, for training without pairs. Items are 'name/key' paths. """
+
+    def __init__(self, path, items, **kwargs):
+        super(HDFImages, self).__init__(path, items, image_keys, **kwargs)
+
+    def __getitem__(self, i):
+        x, = self.read_crop(i)
+
+        # randomly flip
+        if self.xform:
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 0)
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 1)
+
+            k = np.random.randint(4)
+            x = np.rot90(x, k=k)
+
+        x = np.ascontiguousarray(x)
+
+        return x
+
+
+class HDFPairedImages(HDFStore):
+    """
+    Random paired crops (x, y, g) from the store. Items are micrograph names. For stores built without
+    guidance images g is an empty array and the guidance loss is skipped.
+    """
+
+    def __init__(self, path, items, **kwargs):
+        super(HDFPairedImages, self).__init__(path, items, paired_keys, **kwargs)
+        self.has_guidance = all(len(stats) > 2 for stats in self.stats)
+
+    def __getitem__(self, i):
+        crops = self.read_crop(i)
+        x, y = crops[:2]
+        # without guidance the paired image must not stand in for it, after the swap below
+        # it would be the model's own input half of the time
+        g = crops[2] if len(crops) > 2 else np.zeros(0, dtype=np.float32)
+
+        # randomly flip
+        if self.xform:
+            guided = g.size > 0
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 0)
+                y = np.flip(y, 0)
+                if guided:
+                    g = np.flip(g, 0)
+
+            if np.random.rand() > 0.5:
+                x = np.flip(x, 1)
+                y = np.flip(y, 1)
+                if guided:
+                    g = np.flip(g, 1)
+
+            k = np.random.randint(4)
+            x = np.rot90(x, k=k)
+            y = np.rot90(y, k=k)
+            if guided:
+                g = np.rot90(g, k=k)
+
+            # swap x and y
+            if np.random.rand() > 0.5:
+                t = x
+                x = y
+                y = t
+
+        x = np.ascontiguousarray(x)
+        y = np.ascontiguousarray(y)
+        g = np.ascontiguousarray(g)
+
+        return x, y, g
@@ -49,9 +49,10 @@ class ImageTree:
         return self.images[source][name]
 
 def load_mrc(path, standardize=False):
-    with open(path, 'rb') as f:
-        content = f.read()
-    image, header, extended_header = mrc.parse(content)
+    image, header, extended_header = mrc.read(path)
+    if image.dtype == np.float16:
+        # PIL has no half precision images
+        image = image.astype(np.float32)
     # print(image.shape)
     # if len(image.shape) == 3:
     #     image = np.reshape(image, (-1, image.shape[1]))
@@ -104,9 +105,7 @@ def load_pil(path, standardize=False):
     return load_tiff(path, standardize=standardize)
 
 def load_image(path, standardize=False):
-    ## this might be more stable as path.endswith('.mrc')
-    ext = os.path.splitext(path)[1]
-    if ext == '.mrc':
+    if mrc.is_mrc(path):
         image = load_mrc(path, standardize=standardize)
     else:
         image = load_pil(path, standardize=standardize)
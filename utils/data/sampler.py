@@ -231,3 +231,42 @@ class RandomImageTransforms:
         
 
 
+class InfiniteSampler(torch.utils.data.sampler.Sampler):
+    """
+    Draws dataset indices indefinitely, reshuffling on every pass over the dataset.
+    Under torch.distributed each rank takes every world_size-th index of the same permutation, padded
+    by repeating indices to a multiple of world_size as DistributedSampler does, so every rank draws the
+    same number of samples even when the dataset is smaller than the world size.
+    The first start indices of this rank's stream are skipped, so resumed training sees the same data order.
+    """
+    def __init__(self, size, shuffle=True, rank=0, world_size=1, seed=0, start=0):
+        if size <= 0:
+            raise ValueError('InfiniteSampler needs a non-empty dataset')
+        self.size = size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        total = -(-self.size // self.world_size) * self.world_size
+        epoch = 0
+        skip = self.start
+        while True:
+            if self.shuffle:
+                g.manual_seed(self.seed + epoch)
+                order = torch.randperm(self.size, generator=g)
+            else:
+                order = torch.arange(self.size)
+            if total > self.size:
+                order = order.repeat(-(-total // self.size))[:total]
+            order = order[self.rank::self.world_size]
+            if skip >= len(order):
+                skip -= len(order)
+            else:
+                for i in order[skip:]:
+                    yield int(i)
+                skip = 0
+            epoch += 1
@@ -32,16 +32,87 @@ def downsample(x, factor=1, shape=None):
 
     return f.astype(x.dtype)
 
+def thumbnail_shape(shape, size):
+    """ Shape with the longest side at most size pixels and the aspect ratio of shape """
+    m,n = shape[-2:]
+    scale = min(size/max(m,n), 1)
+    return max(int(round(m*scale)), 1), max(int(round(n*scale)), 1)
+
+def thumbnail(x, size):
+    """ Fourier bin a 2d array to fit in size x size pixels, arrays that already fit are returned as they are """
+    shape = thumbnail_shape(x.shape, size)
+    if shape == x.shape[-2:]:
+        return x
+    return downsample(x, shape=shape)
+
+def gaussian_filter(x, sigma):
+    """ Gaussian filter 2d array with standard deviation sigma (in pixels) using fourier transform """
+
+    freq0 = np.fft.fftfreq(x.shape[-2])
+    freq1 = np.fft.rfftfreq(x.shape[-1])
+    r2 = freq0[:,np.newaxis]**2 + freq1[np.newaxis]**2
+
+    F = np.fft.rfft2(x)
+    F *= np.exp(-2*(np.pi*sigma)**2*r2)
+    f = np.fft.irfft2(F, s=x.shape[-2:])
+
+    return f.astype(x.dtype)
+
+# elements per block of the fused normalization, small enough to stay in cache
+NORMALIZE_BLOCK = 1 << 16
+
+def moments(x, ddof=0, block=NORMALIZE_BLOCK):
+    """ Mean and standard deviation of x in one pass, combining the moments of cache sized blocks with Welford's update """
+    flat = x.reshape(-1)
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for start in range(0, flat.size, block):
+        b = flat[start:start+block]
+        nb = b.size
+        mb = b.mean(dtype=np.float64)
+        d = b - b.dtype.type(mb)
+        m2b = float(np.dot(d, d))
+        total = n + nb
+        delta = mb - mean
+        mean += delta*nb/total
+        m2 += m2b + delta*delta*n*nb/total
+        n = total
+    return mean, np.sqrt(m2/max(n - ddof, 1))
+
+def standardize(x, cutoff=0, ddof=0, block=NORMALIZE_BLOCK):
+    """
+    Standardize x to zero mean and unit variance and set pixels more than cutoff standard deviations away to zero.
+    Works in place, block by block, on float32 arrays that are writeable, anything else is copied first. Returns
+    the standardized array with the mean and standard deviation that were removed.
+    """
+    x = np.asarray(x)
+    if x.dtype != np.float32 or not x.flags.writeable or not x.flags.c_contiguous:
+        x = np.array(x, dtype=np.float32, order='C')
+    mu, std = moments(x, ddof=ddof, block=block)
+    mu = np.float32(mu)
+    std = np.float32(std)
+    flat = x.reshape(-1)
+    for start in range(0, flat.size, block):
+        b = flat[start:start+block]
+        b -= mu
+        b /= std
+        if cutoff > 0:
+            b[np.abs(b) > cutoff] = 0
+    return x, mu, std
+
 def quantize(x, mi=-3, ma=3, dtype=np.uint8):
     if mi is None:
         mi = x.min()
     if ma is None:
         ma = x.max()
     r = ma - mi
-    x = 255*(x - mi)/r
-    x = np.clip(x, 0, 255)
-    x = np.round(x).astype(dtype)
-    return x
+    # scale, clip and round in place on one float32 buffer
+    y = np.subtract(x, mi, dtype=np.float32)
+    y *= 255/r
+    np.clip(y, 0, 255, out=y)
+    np.rint(y, out=y)
+    return y.astype(dtype)
     #buckets = np.linspace(mi, ma, 255)
     #return np.digitize(x, buckets).astype(dtype)
 
@@ -51,9 +122,9 @@ def unquantize(x, mi=-3, ma=3, dtype=np.float32):
     y = x*(ma-mi)/255 + mi
     return y
 
-def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
+def save_image(x, path, mi=-3, ma=3, f=None, verbose=False, dtype=np.float32):
     if f is None:
-        f = os.path.splitext(path)[1]
+        f = mrc.splitext(path)[1]
         f = f[1:] # remove the period
     else:
         path = path + '.' + f
@@ -61,8 +132,8 @@ def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
     if verbose:
         print('# saving:', path)
 
-    if f == 'mrc':
-        save_mrc(x, path)
+    if f == 'mrc' or f == 'mrc.gz' or f == 'mrc.xz':
+        save_mrc(x, path, dtype=dtype)
     elif f == 'tiff' or f == 'tif':
         save_tiff(x, path)
     elif f == 'png':
@@ -70,10 +141,10 @@ def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
     elif f == 'jpg' or f == 'jpeg':
         save_jpeg(x, path, mi=mi, ma=ma)
 
-def save_mrc(x, path):
-    with open(path, 'wb') as f:
-        x = x[np.newaxis] # need to add z-axis for mrc write
-        mrc.write(f, x)
+def save_mrc(x, path, dtype=np.float32):
+    # float32 or float16, compressed if path ends with .gz or .xz
+    with mrc.open_file(path, 'wb') as f:
+        mrc.write_tiled(f, x, dtype=dtype)
 
 def save_tiff(x, path):
     im = Image.fromarray(x) 
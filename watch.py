@@ -0,0 +1,108 @@
+from __future__ import print_function, division
+
+import os
+import glob
+import json
+import time
+
+"""
+Watch a directory for micrographs that are still being written during collection.
+
+A file is complete once its size and modification time did not change between two polls and it was
+last modified at least settle seconds ago, MRC files also need to be as long as their header says.
+Processed files are appended to a JSON lines log that survives restarts, a file is only processed again
+if its size or modification time changes.
+"""
+
+
+def mrc_complete(path, size):
+    """ False if the MRC header of path promises more data than size bytes, True otherwise. """
+    import mrc
+    try:
+        with open(path, 'rb') as f:
+            content = f.read(1024)
+        header = mrc.MRCHeader._make(mrc.header_struct.unpack(content))
+    except Exception:
+        # not even a full header yet
+        return False
+    if header.mode not in mrc.MODE_BYTES:
+        return True
+    return size >= 1024 + header.next + header.nx * header.ny * header.nz * mrc.MODE_BYTES[header.mode]
+
+
+class ProcessedLog:
+    """ Append-only record of processed files, one JSON line per file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.outputs = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short if the process was killed while writing it
+                        continue
+                    self.entries[entry['input']] = entry
+                    self.outputs.add(entry['output'])
+
+    def done(self, path, stat):
+        entry = self.entries.get(path)
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def add(self, path, stat, output):
+        entry = {'input': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'output': output, 'time': time.time()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[path] = entry
+        self.outputs.add(output)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FolderWatcher:
+    def __init__(self, directory, log, pattern='*.mrc', settle=5.0):
+        self.directory = directory
+        self.log = log
+        self.pattern = pattern
+        self.settle = settle
+        self.seen = {}
+        self.failed = {}
+
+    def skip(self, path, stat):
+        """ Do not return path again until it changes, e.g. after it failed to load. """
+        self.failed[path] = (stat.st_size, stat.st_mtime)
+
+    def ready(self):
+        """ Complete files that were not processed yet, as (path, stat) in name order. """
+        now = time.time()
+        ready = []
+        for path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            path = os.path.abspath(path)
+            # outputs written into the watched directory are not inputs
+            if path in self.log.outputs:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed or renamed since the listing
+                continue
+            if self.log.done(path, stat):
+                continue
+
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self.seen.get(path)
+            self.seen[path] = signature
+            if previous != signature or self.failed.get(path) == signature:
+                continue
+            if stat.st_size == 0 or now - stat.st_mtime < self.settle:
+                continue
+            if path.endswith('.mrc') and not mrc_complete(path, stat.st_size):
+                continue
+            ready.append((path, stat))
+        return ready